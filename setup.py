@@ -1,17 +1,26 @@
 import argparse
+import fcntl
+import hashlib
+import io
 import json
 import logging
+import math
 import os
 import re
 import sys
 import shlex
+import shutil
 import tempfile
-import pexpect
-from contextlib import contextmanager
+import threading
+import time
+# Rarely used modules (inspect, pexpect, sqlite3, statistics, cProfile and pstats) are imported where they are used,
+# to keep startup fast; see `check_import_time`
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
 from functools import wraps
 from pathlib import Path
-from subprocess import check_output
-from typing import NamedTuple, List, Dict, Any
+from subprocess import check_output, check_call, DEVNULL, STDOUT
+from typing import NamedTuple, List, Dict, Any, Callable, Tuple
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOGLEVEL", "INFO"))
@@ -29,12 +38,65 @@ ZSHRC_PATH = HOME_PATH / ".zshrc"
 ZPROFILE_PATH = HOME_PATH / ".zprofile"
 ZSHENV_PATH = HOME_PATH / ".zshenv"
 GPG_HOME_PATH = HOME_PATH / ".gnupg"
+CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME", HOME_PATH / ".cache")) / "setup"
+DOWNLOAD_CACHE_PATH = CACHE_PATH / "downloads"
+ZINIT_PROFILE_PATH = CACHE_PATH / "zinit-profile.json"
+CCACHE_PATH = CACHE_PATH / "ccache"
+# Wheels shared by every environment, so that packages are only downloaded or built once
+WHEELHOUSE_PATH = CACHE_PATH / "wheelhouse"
+# Built JupyterLab assets, keyed by the JupyterLab version and extension set
+JUPYTERLAB_BUILD_CACHE_PATH = CACHE_PATH / "jupyterlab-builds"
+# Explicit conda lockfiles, keyed by the starting environment and the requested packages
+CONDA_LOCKFILE_CACHE_PATH = CACHE_PATH / "conda-lockfiles"
+# Archives of Python interpreters built by pyenv
+PYTHON_BUILD_CACHE_PATH = CACHE_PATH / "python-builds"
+# Build Python interpreters with profile-guided and link-time optimisation, which is several times slower
+PYTHON_OPTIMIZED_BUILD = os.environ.get("SETUP_PYTHON_OPTIMIZED_BUILD", "") not in ("", "0")
+# Solver used for conda transactions (e.g. "libmamba"), or conda's default if empty
+CONDA_SOLVER = os.environ.get("SETUP_CONDA_SOLVER", "")
+# ccache evicts the least recently used objects once the cache exceeds this size
+CCACHE_MAX_SIZE = os.environ.get("SETUP_CCACHE_MAX_SIZE", "20G")
+# Repository of packages built from source, which may be a shared mount
+BUILT_PACKAGES_PATH = Path(os.environ.get("SETUP_APT_REPOSITORY", CACHE_PATH / "apt-repository"))
+BUILT_PACKAGES_SOURCE_PATH = Path("/etc/apt/sources.list.d/setup-built-packages.list")
+# Memory pressure (PSI "some avg10", percent) above which build tokens are withheld, and below which they are returned
+MEMORY_PRESSURE_HIGH = 10.0
+MEMORY_PRESSURE_LOW = 2.0
+STATE_PATH = Path(os.environ.get("XDG_STATE_HOME", HOME_PATH / ".local" / "state")) / "setup"
+JOURNAL_PATH = STATE_PATH / "journal.jsonl"
+TIMINGS_PATH = STATE_PATH / "timings.sqlite"
+# Installer arguments whose names match this are redacted wherever installer calls are logged or recorded
+SECRET_ARGUMENT_PATTERN = re.compile(r"token|password|secret", re.IGNORECASE)
+# Interval in seconds between refreshes of the cached sudo credentials, well within sudo's default timeout
+SUDO_REFRESH_INTERVAL = 60.0
+# Interval in seconds between samples of system resource use during a provision
+RESOURCE_SAMPLE_INTERVAL = 1.0
+# Slow-downs shorter than this (in seconds) are not reported as regressions, as they are usually noise
+REGRESSION_MIN_SECONDS = 5.0
+GITHUB_CACHE_PATH = CACHE_PATH / "github"
+# Overridable so that a local stand-in for the API can be used
+GITHUB_GRAPHQL_URL = os.environ.get("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+# Lifetime of cached GitHub API responses in seconds
+GITHUB_CACHE_TTL = 60 * 60
 GEANT4_CPACK_PATCH_URL = (
     "https://gist.github.com/agoose77/fba2fc5504933b7fb2c5b8c3cfd93529/raw"
 )
 TMUX_CONF_URL = (
     "https://gist.githubusercontent.com/agoose77/3e3b273cbfdb8a870c97ebb346beef8e/raw"
 )
+JUPYTERLAB_APP_SOURCE = """
+import json, jupyterlab
+from jupyterlab.commands import get_app_dir
+print(json.dumps({'version': jupyterlab.__version__, 'app_dir': get_app_dir()}))
+"""
+# Modules whose first import is timed before and after precompiling bytecode
+FIRST_IMPORT_MODULES = ("jupyter", "jupyterlab", "nbdime", "matplotlib.pyplot", "numba", "ROOT")
+FIRST_IMPORT_TIME_SOURCE = """
+import sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(time.perf_counter() - start)
+"""
 EXPORT_OS_ENVIRON_SOURCE = f"""
 import os, json, sys
 with open(sys.argv[1], 'w') as f:
@@ -53,30 +115,53 @@ class SysconfigData(NamedTuple):
     executable: str
 
 
-_depth = 0
+class Step(NamedTuple):
+    func: Callable
+    args: Tuple = ()
+    kwargs: Dict[str, Any] = {}
+
+
+# Nesting depth of installers, tracked per thread so that concurrent installers log independently
+_local = threading.local()
+
+# Package managers hold system-wide locks, so only one installer may use them at a time
+APT_LOCK = threading.RLock()
+SNAP_LOCK = threading.RLock()
+ENV_LOCK = threading.RLock()
+
+# Per-URL locks which prevent concurrent installers from fetching the same file twice
+_download_locks: Dict[str, threading.Lock] = {}
+DOWNLOAD_INDEX_LOCK = threading.Lock()
+# Held whilst wheels are added to the wheelhouse, so that concurrent installers do not write the same wheel
+WHEELHOUSE_LOCK = threading.Lock()
+
+# Packages and repositories which have already been installed during this run
+_installed_apt_packages = set()
+_added_apt_repositories = set()
 
 
 # Logging and utilities ################################################################################################
 @contextmanager
 def context():
-    global _depth
-    _depth += 1
-    yield
-    _depth -= 1
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
 
 
 def prefix():
-    return "   " * _depth
+    return "   " * getattr(_local, "depth", 0)
 
 
 def log(message, level=logging.INFO):
     try:
-        colors = plumbum.colors
-    except NameError:
+        import plumbum.colors as colors
+    except ImportError:
         pass
     else:
         log_level_to_colour = {
-            logging.DEBUG: colors.fg,
+            logging.DEBUG: colors.dim,
             logging.INFO: colors.info,
             logging.WARN: colors.warn,
             logging.ERROR: colors.fatal,
@@ -89,57 +174,1312 @@ def log(message, level=logging.INFO):
 def installer(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        arg_strings = [repr(a) for a in args]
-        kwarg_strings = [f"{k}={v!r}" for k, v in kwargs.items()]
-        func_string = f"{func.__name__}({', '.join([*arg_strings, *kwarg_strings])})"
+        func_string = format_installer_call(func, args, kwargs)
+
+        fingerprint = get_installer_fingerprint(func, args, kwargs)
+        entry = JOURNAL.get(fingerprint) if JOURNAL is not None else None
+        # A skipped installer has no result, so helpers whose results are used must not be named install_*
+        if entry is not None:
+            log(f"Skipping {func_string}, which finished in a previous run")
+            ZSHRC.replay(entry["zshrc"])
+            return None
 
         log(f"Running {func_string}")
-        with context():
+        start_time = time.monotonic()
+        started = time.time()
+        with context(), ZSHRC.recording() as zshrc_changes, trace_span(func_string, "installer"), \
+                installed_versions() as versions, running_installer(func_string):
             try:
+                # Apply environment changes deferred by `modifies_environment` at installer boundaries
+                refresh_environment()
+                ensure_apt_requirements(func)
                 result = func(*args, **kwargs)
+                refresh_environment()
             except Exception:
                 log(
                     f"Execution of {func_string} failed", level=logging.ERROR,
                 )
+                if TIMINGS is not None:
+                    TIMINGS.record_installer(func_string, started, time.monotonic() - start_time, False, versions)
                 raise
 
+        if TIMINGS is not None:
+            versions.update(get_apt_package_versions(getattr(func, "apt_packages", ())))
+            TIMINGS.record_installer(func_string, started, time.monotonic() - start_time, True, versions)
+
+        if JOURNAL is not None:
+            JOURNAL.record(
+                fingerprint,
+                {
+                    "installer": func.__name__,
+                    "arguments": func_string,
+                    "duration": time.monotonic() - start_time,
+                    "finished": time.time(),
+                    "zshrc": zshrc_changes,
+                },
+            )
         log(f"Finished {func_string}")
         return result
 
     return wrapper
 
 
+def format_installer_call(func, args, kwargs) -> str:
+    """Describe a call of an installer for logs, traces and the timing database, with secret arguments redacted"""
+    import inspect
+
+    parameters = inspect.signature(func).parameters.values()
+    positional_names = [p.name for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    variadic_name = next((p.name for p in parameters if p.kind is p.VAR_POSITIONAL), "")
+
+    def format_value(name, value):
+        return "'<redacted>'" if SECRET_ARGUMENT_PATTERN.search(name) else repr(value)
+
+    arg_strings = [
+        format_value(positional_names[i] if i < len(positional_names) else variadic_name, a)
+        for i, a in enumerate(args)
+    ]
+    kwarg_strings = [f"{k}={format_value(k, v)}" for k, v in kwargs.items()]
+    return f"{func.__name__}({', '.join([*arg_strings, *kwarg_strings])})"
+
+
+def get_installer_fingerprint(func, args, kwargs) -> str:
+    """Return a hash of an installer's source and arguments, which changes whenever either of these does"""
+    import inspect
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        # Source is unavailable when the script is piped into the interpreter
+        source = repr((func.__code__.co_code, func.__code__.co_consts))
+    arguments = repr((args, sorted(kwargs.items())))
+    return hashlib.sha256(f"{func.__name__}\n{arguments}\n{source}".encode()).hexdigest()
+
+
+class RunJournal:
+    """Persistent record of completed installers, which lets a failed provision resume where it stopped.
+
+    Each entry is keyed by the installer fingerprint, and holds the changes that the installer made to .zshrc so that
+    they can be replayed when it is skipped.
+    """
+
+    def __init__(self, path: Path, resume: bool = True, read_only: bool = False):
+        self.path = path
+        self.resume = resume
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may have been cut short by an interrupted run
+                        continue
+                    self.entries[record["fingerprint"]] = record["entry"]
+        except FileNotFoundError:
+            pass
+
+        # Entries are appended as JSON lines, so drop those which later entries replaced before appending again
+        if self.entries and not read_only:
+            self._write(self.entries.items(), mode="w")
+
+    def _write(self, records, mode: str):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lines = "".join(json.dumps({"fingerprint": k, "entry": v}) + "\n" for k, v in records)
+        if mode == "a":
+            # Keep the journal private, like the timing database
+            with open(os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), "a") as f:
+                f.write(lines)
+            return
+
+        temp_path = self.path.with_suffix(".tmp")
+        with open(os.open(temp_path, os.O_WRONLY | os.O_TRUNC | os.O_CREAT, 0o600), "w") as f:
+            f.write(lines)
+        os.replace(temp_path, self.path)
+
+    def get(self, fingerprint: str) -> Dict[str, Any]:
+        return self.entries.get(fingerprint) if self.resume else None
+
+    def clear(self):
+        """Forget every entry once a provision has finished, so that the next provision runs every installer again"""
+        with self._lock:
+            self.entries = {}
+            if self.read_only:
+                return
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def record(self, fingerprint: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.entries[fingerprint] = entry
+            if not self.read_only:
+                self._write([(fingerprint, entry)], mode="a")
+
+
+# Journal of the current provision, if any
+JOURNAL: RunJournal = None
+
+
+class TraceRecorder:
+    """Collector of events in the Chrome trace event format, which can be opened with Perfetto or chrome://tracing"""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self._thread_names = {}
+        self._downloaded_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _timestamp() -> float:
+        return time.perf_counter() * 1e6
+
+    def _add(self, event: Dict[str, Any]):
+        thread = threading.current_thread()
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self.events.append({"pid": os.getpid(), "tid": thread.ident, **event})
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        """Record the duration of the body as a complete event.
+
+        :param name: name of span
+        :param category: category of span
+        :param args: arguments shown with the span, which the body may add to
+        :return: span arguments
+        """
+        start = self._timestamp()
+        try:
+            yield args
+        finally:
+            self._add({"name": name, "cat": category, "ph": "X", "ts": start, "dur": self._timestamp() - start,
+                       "args": args})
+
+    def count_downloaded_bytes(self, n_bytes: int):
+        with self._lock:
+            self._downloaded_bytes += n_bytes
+            total = self._downloaded_bytes
+        self.count("downloaded", bytes=total)
+
+    def count(self, name: str, **values: float):
+        """Record the values of a counter"""
+        self._add({"name": name, "ph": "C", "ts": self._timestamp(), "args": values})
+
+    def write(self, path: Path):
+        thread_names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in self._thread_names.items()
+        ]
+        path.write_text(json.dumps({"traceEvents": thread_names + self.events, "displayTimeUnit": "ms"}))
+
+
+# Trace of the current provision, if any
+TRACE: TraceRecorder = None
+
+
+def read_os_release() -> str:
+    """Return the name and version of the operating system, or None if it is unknown"""
+    try:
+        os_release = re.search(r'^PRETTY_NAME="?(.*?)"?$', Path("/etc/os-release").read_text(), re.MULTILINE)
+    except FileNotFoundError:
+        return None
+    return os_release and os_release.group(1)
+
+
+def get_machine_info() -> Dict[str, Any]:
+    """Describe the hardware and operating system that installers run on"""
+    cpuinfo = Path("/proc/cpuinfo").read_text()
+    cpu_model = re.search(r"^model name\s*:\s*(.*)$", cpuinfo, re.MULTILINE)
+    meminfo = Path("/proc/meminfo").read_text()
+    return {
+        "hostname": os.uname().nodename,
+        "kernel": os.uname().release,
+        "os": read_os_release(),
+        "architecture": os.uname().machine,
+        "cpu": cpu_model and cpu_model.group(1),
+        "n_threads": get_max_system_threads(),
+        "memory_kb": int(re.search(r"^MemTotal:\s+(\d+) kB", meminfo, re.MULTILINE).group(1)),
+    }
+
+
+def get_machine_fingerprint(machine: Dict[str, Any]) -> str:
+    """Identify the hardware described by `get_machine_info`.
+
+    The hostname, kernel and usable threads (which follow CPU affinity) are left out, as they change without the
+    hardware doing so. MemTotal also varies slightly between kernels, so it is compared in whole GiB.
+    """
+    hardware = {
+        "cpu": machine.get("cpu"),
+        "memory_gib": round(machine["memory_kb"] / 2 ** 20),
+    }
+    return hashlib.sha256(json.dumps(hardware, sort_keys=True).encode()).hexdigest()
+
+
+class TimingDatabase:
+    """SQLite history of installer durations, and the versions they installed, across provisions"""
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    machine TEXT NOT NULL,
+    machine_fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS installers (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    installer TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    succeeded INTEGER NOT NULL,
+    versions TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS installers_by_name ON installers(installer, started);
+CREATE TABLE IF NOT EXISTS samples (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    time REAL NOT NULL,
+    installers TEXT NOT NULL,
+    cpu_busy REAL NOT NULL,
+    cpu_iowait REAL NOT NULL,
+    memory_available_kb INTEGER NOT NULL,
+    cpu_pressure REAL,
+    memory_pressure REAL,
+    io_pressure REAL,
+    read_bytes_per_second REAL NOT NULL,
+    written_bytes_per_second REAL NOT NULL
+);
+"""
+
+    def __init__(self, path: Path):
+        import sqlite3
+
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Installer arguments may include tokens, so keep the database private
+        path.touch(mode=0o600)
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self.run_id = None
+        self._update_machine_fingerprints()
+
+    def _update_machine_fingerprints(self):
+        """Recompute the fingerprints of earlier runs, so that their history is kept if the fingerprint changes"""
+        with self._connection:
+            for run_id, machine, fingerprint in self._connection.execute(
+                "SELECT id, machine, machine_fingerprint FROM runs"
+            ).fetchall():
+                new_fingerprint = get_machine_fingerprint(json.loads(machine))
+                if new_fingerprint != fingerprint:
+                    self._connection.execute(
+                        "UPDATE runs SET machine_fingerprint = ? WHERE id = ?", (new_fingerprint, run_id)
+                    )
+
+    def start_run(self, machine: Dict[str, Any]) -> int:
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (started, machine, machine_fingerprint) VALUES (?, ?, ?)",
+                (time.time(), json.dumps(machine, sort_keys=True), get_machine_fingerprint(machine)),
+            )
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def record_installer(self, installer: str, started: float, duration: float, succeeded: bool,
+                         versions: Dict[str, str]):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO installers (run_id, installer, started, duration, succeeded, versions) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id, installer, started, duration, succeeded, json.dumps(versions, sort_keys=True)),
+            )
+
+    def record_sample(self, sample: "ResourceSample"):
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT INTO samples (run_id, {', '.join(ResourceSample._fields)}) "
+                f"VALUES (?, {', '.join('?' * len(ResourceSample._fields))})",
+                (self.run_id, *sample._replace(installers=json.dumps(sample.installers))),
+            )
+
+    def get_latest_run_samples(self, machine_fingerprint: str = None) -> List["ResourceSample"]:
+        """Return the resource samples of the most recent run
+
+        :param machine_fingerprint: only consider runs on this machine
+        :return:
+        """
+        query = "SELECT MAX(id) FROM runs"
+        parameters = ()
+        if machine_fingerprint is not None:
+            query += " WHERE machine_fingerprint = ?"
+            parameters = (machine_fingerprint,)
+
+        with self._lock:
+            (run_id,), = self._connection.execute(query, parameters)
+            rows = self._connection.execute(
+                f"SELECT {', '.join(ResourceSample._fields)} FROM samples WHERE run_id = ? ORDER BY time", (run_id,)
+            ).fetchall()
+        return [ResourceSample(*row)._replace(installers=json.loads(row[1])) for row in rows]
+
+    def get_durations(self, machine_fingerprint: str = None) -> Dict[str, List[Tuple[float, float, str]]]:
+        """Return the (start time, duration, versions) of successful runs of each installer, oldest first
+
+        :param machine_fingerprint: only include runs on this machine
+        :return:
+        """
+        query = (
+            "SELECT installer, installers.started, duration, versions FROM installers "
+            "JOIN runs ON runs.id = installers.run_id WHERE succeeded"
+        )
+        parameters = ()
+        if machine_fingerprint is not None:
+            query += " AND machine_fingerprint = ?"
+            parameters = (machine_fingerprint,)
+
+        durations = {}
+        with self._lock:
+            for installer, started, duration, versions in self._connection.execute(
+                query + " ORDER BY installers.started", parameters
+            ):
+                durations.setdefault(installer, []).append((started, duration, versions))
+        return durations
+
+    def close(self):
+        self._connection.close()
+
+
+# Timing history of the current provision, if any
+TIMINGS: TimingDatabase = None
+
+
+class ResourceSample(NamedTuple):
+    time: float
+    installers: List[str]
+    # Shares of CPU time (0-1) across all CPUs
+    cpu_busy: float
+    cpu_iowait: float
+    memory_available_kb: int
+    # PSI "some avg10" percentages, if available
+    cpu_pressure: float
+    memory_pressure: float
+    io_pressure: float
+    read_bytes_per_second: float
+    written_bytes_per_second: float
+
+
+class ProcCounters(NamedTuple):
+    time: float
+    cpu_busy: int
+    cpu_iowait: int
+    cpu_total: int
+    sectors_read: int
+    sectors_written: int
+
+
+# Installers running on each thread, innermost last
+_running_installers: Dict[int, List[str]] = {}
+
+
 @contextmanager
-def detect_changed_files(directory):
-    path = Path(directory).expanduser()
-    before_files = set(path.iterdir())
-    changed_files = set()
-    yield changed_files
-    changed_files |= set(path.iterdir()) - before_files
+def running_installer(name: str):
+    """Mark an installer as running on the current thread, so that resource samples are attributed to it"""
+    stack = _running_installers.setdefault(threading.get_ident(), [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def read_proc_counters() -> ProcCounters:
+    # Fields of the aggregate line are user, nice, system, idle, iowait, irq, softirq, steal, ...
+    cpu = [int(v) for v in Path("/proc/stat").read_text().splitlines()[0].split()[1:9]]
+    idle, iowait = cpu[3], cpu[4]
+
+    # Count whole disks only, as partitions repeat the counts of their disk
+    disks = {p.name for p in Path("/sys/block").iterdir() if not p.name.startswith(("loop", "ram"))}
+    sectors_read = sectors_written = 0
+    for line in Path("/proc/diskstats").read_text().splitlines():
+        fields = line.split()
+        if fields[2] in disks:
+            sectors_read += int(fields[5])
+            sectors_written += int(fields[9])
+
+    return ProcCounters(
+        time=time.time(),
+        cpu_busy=sum(cpu) - idle - iowait,
+        cpu_iowait=iowait,
+        cpu_total=sum(cpu),
+        sectors_read=sectors_read,
+        sectors_written=sectors_written,
+    )
 
 
-def reload_plumbum_env() -> Dict[str, Any]:
-    """Reloads `local.env` after re-sourcing .zshrc"""
-    fd, temp_path = tempfile.mkstemp()
+class ResourceSampler:
+    """Background thread which samples CPU, memory, pressure and disk I/O from /proc at a fixed interval.
 
-    with local.env(ZINIT_WAIT=" "):
-        (cmd.zsh["-is"] << f"{sys.executable} -c {shlex.quote(EXPORT_OS_ENVIRON_SOURCE)} {temp_path}")()
-        
-    with open(fd) as f:
-        env = json.load(f)
-    local.env.update(**env)
-    return env
+    Each sample is tagged with the installers running at the time, and stored in the timing database.
+    """
+
+    def __init__(self, database: TimingDatabase, interval: float = RESOURCE_SAMPLE_INTERVAL):
+        self.database = database
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        previous = read_proc_counters()
+        while not self._stop.wait(self.interval):
+            current = read_proc_counters()
+            sample = self._make_sample(previous, current)
+            previous = current
+
+            self.database.record_sample(sample)
+            if TRACE is not None:
+                TRACE.count("cpu", busy=sample.cpu_busy, iowait=sample.cpu_iowait)
+                TRACE.count("memory available", kb=sample.memory_available_kb)
+
+    @staticmethod
+    def _make_sample(previous: ProcCounters, current: ProcCounters) -> ResourceSample:
+        elapsed = current.time - previous.time
+        cpu_total = max(current.cpu_total - previous.cpu_total, 1)
+        meminfo = Path("/proc/meminfo").read_text()
+        installers = list(dict.fromkeys(name for stack in list(_running_installers.values()) for name in stack))
+        return ResourceSample(
+            time=current.time,
+            installers=installers,
+            cpu_busy=(current.cpu_busy - previous.cpu_busy) / cpu_total,
+            cpu_iowait=(current.cpu_iowait - previous.cpu_iowait) / cpu_total,
+            memory_available_kb=int(re.search(r"^MemAvailable:\s+(\d+) kB", meminfo, re.MULTILINE).group(1)),
+            cpu_pressure=read_pressure("cpu"),
+            memory_pressure=read_pressure("memory"),
+            io_pressure=read_pressure("io"),
+            # Disk statistics are always counted in 512 byte sectors
+            read_bytes_per_second=(current.sectors_read - previous.sectors_read) * 512 / elapsed,
+            written_bytes_per_second=(current.sectors_written - previous.sectors_written) * 512 / elapsed,
+        )
+
+
+def classify_resource_use(samples: List[ResourceSample]) -> str:
+    """Name the resource that most limited progress over a set of samples"""
+    import statistics
+
+    memory_pressure = statistics.mean(s.memory_pressure or 0.0 for s in samples)
+    io_pressure = statistics.mean(s.io_pressure or 0.0 for s in samples)
+    iowait = statistics.mean(s.cpu_iowait for s in samples)
+    cpu_busy = statistics.mean(s.cpu_busy for s in samples)
+
+    if memory_pressure > MEMORY_PRESSURE_HIGH:
+        return "memory-bound"
+    if io_pressure > 10.0 or iowait > 0.2:
+        return "I/O-bound"
+    if cpu_busy > 0.7:
+        return "CPU-bound"
+    return "waiting (network or serial work)"
+
+
+def report_resource_usage(samples: List[ResourceSample]):
+    """Log a summary of the resource samples attributed to each installer"""
+    import statistics
+
+    by_installer = {}
+    for sample in samples:
+        for name in sample.installers:
+            by_installer.setdefault(name, []).append(sample)
+
+    for name, installer_samples in sorted(by_installer.items()):
+        log(
+            f"{name}: {classify_resource_use(installer_samples)}, "
+            f"CPU {100 * statistics.mean(s.cpu_busy for s in installer_samples):.0f}% "
+            f"(iowait {100 * statistics.mean(s.cpu_iowait for s in installer_samples):.0f}%), "
+            f"min. available memory {min(s.memory_available_kb for s in installer_samples) / 2 ** 20:.1f} GiB, "
+            f"disk {statistics.mean(s.read_bytes_per_second for s in installer_samples) / 2 ** 20:.1f} MiB/s read "
+            f"{statistics.mean(s.written_bytes_per_second for s in installer_samples) / 2 ** 20:.1f} MiB/s written"
+        )
+
+
+@contextmanager
+def installed_versions():
+    """Collect the versions recorded with `record_installed_version` by the current installer"""
+    stack = _local.__dict__.setdefault("versions", [])
+    stack.append({})
+    try:
+        yield stack[-1]
+    finally:
+        stack.pop()
+
+
+def record_installed_version(name: str, version: str):
+    """Record the version of something installed by the running installer, for the timing history"""
+    stack = getattr(_local, "versions", ())
+    if stack:
+        stack[-1][name] = version
+
+
+def sparkline(values: List[float]) -> str:
+    bars = "▁▂▃▄▅▆▇█"
+    lowest, highest = min(values), max(values)
+    scale = (len(bars) - 1) / (highest - lowest) if highest > lowest else 0
+    return "".join(bars[round((v - lowest) * scale)] for v in values)
+
+
+def report_installer_timings(threshold: float = 20.0, window: int = 5, all_machines: bool = False) -> bool:
+    """Log the duration trend of each installer, flagging those which got slower than the median of recent runs.
+
+    :param threshold: percentage slow-down relative to the rolling median which counts as a regression
+    :param window: number of previous runs in the rolling median
+    :param all_machines: include runs on other machines, rather than just this one
+    :return: whether no installer regressed
+    """
+    import statistics
+
+    database = TimingDatabase(TIMINGS_PATH)
+    fingerprint = None if all_machines else get_machine_fingerprint(get_machine_info())
+    durations = database.get_durations(fingerprint)
+    samples = database.get_latest_run_samples(fingerprint)
+    database.close()
+
+    if not durations:
+        log("No installer timings have been recorded", logging.WARN)
+        return True
+
+    n_regressions = 0
+    for installer, runs in sorted(durations.items()):
+        _, latest, versions = runs[-1]
+        trend = sparkline([d for _, d, _ in runs[-10:]])
+        previous = [d for _, d, _ in runs[-window - 1 : -1]]
+        if not previous:
+            log(f"{installer}: {format_duration(latest)} (first run)")
+            continue
+
+        median = statistics.median(previous)
+        change = 100 * (latest - median) / median if median else 0.0
+        message = (
+            f"{installer}: {format_duration(latest)}, {change:+.0f}% relative to median of "
+            f"{format_duration(median)} over {len(previous)} run(s) {trend}"
+        )
+        if change <= threshold or latest - median < REGRESSION_MIN_SECONDS:
+            log(message)
+            continue
+
+        n_regressions += 1
+        old_versions, new_versions = json.loads(runs[-2][2]), json.loads(versions)
+        changed = [
+            f"{k} {old_versions.get(k)} -> {v}" for k, v in sorted(new_versions.items()) if old_versions.get(k) != v
+        ]
+        if changed:
+            message += f" (changed: {', '.join(changed)})"
+        log(message, logging.ERROR)
+
+    log(f"{n_regressions} installer(s) were more than {threshold:.0f}% slower than their rolling median")
+
+    if samples:
+        log("Resource use in the latest run:")
+        with context():
+            report_resource_usage(samples)
+    return not n_regressions
+
+
+def get_apt_package_versions(packages) -> Dict[str, str]:
+    if not packages:
+        return {}
+    output = cmd.dpkg_query.run(("-W", "-f=${Package} ${Version}\n", *packages), retcode=None)[1]
+    return dict(line.split(" ", 1) for line in output.splitlines() if " " in line)
+
+
+@contextmanager
+def trace_span(name: str, category: str, **args):
+    if TRACE is None:
+        yield args
+        return
+    with TRACE.span(name, category, **args) as args:
+        yield args
+
+
+@contextmanager
+def tracing(path: Path):
+    """Trace installers, downloads and subprocesses (started by plumbum or `check_output`/`check_call`) to `path`"""
+    global TRACE, check_output, check_call
+    import plumbum.commands.base
+
+    def traced_run(self, *args, **kwargs):
+        with trace_span(str(self), "subprocess"):
+            return original_run(self, *args, **kwargs)
+
+    def traced(func):
+        @wraps(func)
+        def wrapper(args, **kwargs):
+            with trace_span(" ".join(map(str, args)), "subprocess"):
+                return func(args, **kwargs)
+        return wrapper
+
+    original_run = plumbum.commands.base.BaseCommand.run
+    original_check_output, original_check_call = check_output, check_call
+
+    TRACE = TraceRecorder()
+    plumbum.commands.base.BaseCommand.run = traced_run
+    check_output, check_call = traced(check_output), traced(check_call)
+    try:
+        yield TRACE
+    finally:
+        plumbum.commands.base.BaseCommand.run = original_run
+        check_output, check_call = original_check_output, original_check_call
+        TRACE.write(path)
+        TRACE = None
+        log(f"Wrote trace to {path}")
+
+
+def requires(*dependencies):
+    """Declare the installers which must have finished before the decorated installer may run.
+
+    :param dependencies: installer functions or their names
+    :return:
+    """
+    names = tuple(d if isinstance(d, str) else d.__name__ for d in dependencies)
+
+    def decorator(func):
+        func.requires = names
+        return func
+
+    return decorator
+
+
+def uses_apt(*packages: str, repositories=()):
+    """Declare the apt packages (and any additional repositories) that the decorated installer needs.
+
+    Declared packages are installed before the installer runs, and may be collected from many installers into a
+    single apt transaction with `preinstall_apt_packages`.
+
+    :param packages: apt package names
+    :param repositories: apt repositories which provide the packages
+    :return:
+    """
+
+    def decorator(func):
+        func.apt_packages = packages
+        func.apt_repositories = tuple(repositories)
+        return func
+
+    return decorator
+
+
+def run_steps(steps: List[Step], n_jobs: int = 1):
+    """Run installation steps on a thread pool, honouring installer dependencies.
+
+    A step waits for every earlier step whose installer it requires. Independent steps run concurrently,
+    whilst a single job runs the steps strictly in the given order.
+
+    :param steps: ordered list of steps
+    :param n_jobs: maximum number of concurrently running steps
+    :return:
+    """
+    dependencies = [
+        {
+            j
+            for j, other in enumerate(steps[:i])
+            if other.func.__name__ in getattr(step.func, "requires", ())
+        }
+        for i, step in enumerate(steps)
+    ]
+    pending = list(range(len(steps)))
+    finished = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        while pending or running:
+            ready = [i for i in pending if dependencies[i] <= finished]
+            for i in ready[: n_jobs - len(running)]:
+                pending.remove(i)
+                step = steps[i]
+                running[executor.submit(step.func, *step.args, **step.kwargs)] = i
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                # Re-raise failures, leaving remaining steps unscheduled
+                future.result()
+                finished.add(i)
+
+
+# Downloads ############################################################################################################
+def load_download_index() -> Dict[str, Dict[str, str]]:
+    try:
+        return json.loads((DOWNLOAD_CACHE_PATH / "index.json").read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def update_download_index(url: str, entry: Dict[str, str]):
+    with DOWNLOAD_INDEX_LOCK:
+        index = load_download_index()
+        index[url] = entry
+
+        # Replace atomically so that an interrupted run cannot corrupt the index
+        index_path = DOWNLOAD_CACHE_PATH / "index.json"
+        temp_path = index_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(index, indent=2))
+        os.replace(temp_path, index_path)
+
+
+def get_download_filename(response, url: str) -> str:
+    from email.message import Message
+    from urllib.parse import urlparse, unquote
+
+    message = Message()
+    message["Content-Disposition"] = response.headers.get("Content-Disposition", "")
+    filename = message.get_param("filename", header="Content-Disposition")
+    if not filename:
+        filename = unquote(Path(urlparse(response.geturl() or url).path).name)
+    return filename or "download"
+
+
+def download(url: str, destination=None) -> Path:
+    """Download a file through the persistent download cache.
+
+    Files are stored by content hash, and cached entries are revalidated with the server using their ETag or
+    Last-Modified headers. Interrupted downloads are resumed where the server supports it, and the cached copy is
+    used if the server cannot be reached.
+
+    :param url: URL to fetch
+    :param destination: optional path (or existing directory) to copy the file to
+    :return: path to the downloaded file
+    """
+    import urllib.request as request
+    import urllib.error as error
+
+    with DOWNLOAD_INDEX_LOCK:
+        lock = _download_locks.setdefault(url, threading.Lock())
+
+    with lock, trace_span(f"download {url}", "download") as span_args:
+        DOWNLOAD_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        entry = load_download_index().get(url)
+        cached_path = None
+        if entry is not None:
+            cached_path = DOWNLOAD_CACHE_PATH / entry["sha256"] / entry["filename"]
+            if not cached_path.exists():
+                entry = cached_path = None
+
+        headers = {"User-Agent": "setup.py"}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        # Resume a previously interrupted download of this URL
+        partial_path = DOWNLOAD_CACHE_PATH / f"{hashlib.sha256(url.encode()).hexdigest()}.part"
+        if entry is None and partial_path.exists():
+            headers["Range"] = f"bytes={partial_path.stat().st_size}-"
+
+        response = None
+        try:
+            response = request.urlopen(request.Request(url, headers=headers))
+        except error.HTTPError as err:
+            if err.code == 304:
+                log(f"Using cached {url}", logging.DEBUG)
+                path = cached_path
+            elif err.code == 416:
+                # Partial file is stale, start again
+                partial_path.unlink()
+                response = request.urlopen(request.Request(url, headers={"User-Agent": "setup.py"}))
+            else:
+                raise
+        except error.URLError:
+            if cached_path is None:
+                raise
+            log(f"Unable to revalidate {url}, using cached copy", logging.WARN)
+            path = cached_path
+
+        if response is not None:
+            with response:
+                checksum = hashlib.sha256()
+                if response.status == 206:
+                    with open(partial_path, "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            checksum.update(chunk)
+                    mode = "ab"
+                else:
+                    mode = "wb"
+
+                with open(partial_path, mode) as f:
+                    for chunk in iter(lambda: response.read(1 << 20), b""):
+                        checksum.update(chunk)
+                        f.write(chunk)
+                        span_args["bytes"] = span_args.get("bytes", 0) + len(chunk)
+                        if TRACE is not None:
+                            TRACE.count_downloaded_bytes(len(chunk))
+
+                entry = {
+                    "sha256": checksum.hexdigest(),
+                    "filename": get_download_filename(response, url),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+
+            path = DOWNLOAD_CACHE_PATH / entry["sha256"] / entry["filename"]
+            path.parent.mkdir(exist_ok=True)
+            os.replace(partial_path, path)
+            update_download_index(url, entry)
+
+    if destination is None:
+        return path
+
+    destination = Path(destination).expanduser()
+    if destination.is_dir():
+        destination = destination / path.name
+    shutil.copyfile(path, destination)
+    return destination
+
+
+# Shell configuration ##################################################################################################
+class ZshrcDocument:
+    """In-memory model of .zshrc, composed of named sections which are rendered in a fixed order.
+
+    Installers add to the relevant section rather than rewriting the file, and the document is written out once.
+    """
+
+    SECTIONS = ("header", "sources", "path", "settings", "plugins", "aliases", "footer")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.sections: Dict[str, List[str]] = {name: [] for name in self.SECTIONS}
+        self.path: List[str] = ["$HOME/.local/bin", "$PATH"]
+
+        # Environment snippets which have not yet been applied to `local.env`
+        self._pending_sources: List[str] = []
+        self._pending_path: List[str] = []
+
+        # Stacks of change lists, per thread, which are recorded into by `recording`
+        self._recordings = threading.local()
+
+    @contextmanager
+    def recording(self):
+        """Record the changes made to the document by the current thread, including those of nested recordings"""
+        changes = []
+        stack = self._recordings.__dict__.setdefault("stack", [])
+        stack.append(changes)
+        try:
+            yield changes
+        finally:
+            stack.pop()
+
+    def _record(self, *change):
+        for changes in getattr(self._recordings, "stack", ()):
+            changes.append(change)
+
+    def replay(self, changes: List[List[str]]):
+        """Apply changes obtained from `recording`"""
+        for kind, *arguments in changes:
+            getattr(self, kind)(*arguments)
+
+    def append(self, section: str, *scripts: str):
+        self._record("append", section, *scripts)
+        with self._lock:
+            self.sections[section].extend(scripts)
+            if section == "sources":
+                self._pending_sources.extend(scripts)
+
+    def prepend_path(self, *components: str):
+        self._record("prepend_path", *components)
+        with self._lock:
+            for component in components:
+                if component not in self.path:
+                    self.path.insert(0, component)
+                    self._pending_path.insert(0, component)
+
+    def pop_environment_script(self) -> str:
+        """Return a script which applies the environment changes made since the last call, in .zshrc order"""
+        with self._lock:
+            scripts = [s.strip() for s in self._pending_sources]
+            if self._pending_path:
+                scripts.append(f'export PATH="{":".join(self._pending_path)}:$PATH"')
+            self._pending_sources.clear()
+            self._pending_path.clear()
+        return "\n".join(scripts)
+
+    def render(self) -> str:
+        with self._lock:
+            sections = {**self.sections, "path": [f'export PATH="{":".join(self.path)}"']}
+            blocks = [
+                "\n".join(s.strip() for s in sections[name])
+                for name in self.SECTIONS
+                if sections[name]
+            ]
+        return "\n\n".join(blocks) + "\n"
+
+    def write(self, path: Path = None):
+        """Atomically replace the file at `path` (by default, .zshrc) with the rendered document"""
+        if path is None:
+            path = ZSHRC_PATH
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.")
+        with open(fd, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+ZSHRC = ZshrcDocument()
+
+
+# Variables which the evaluating shell itself sets
+SHELL_STATE_VARIABLES = {"_", "PWD", "OLDPWD", "SHLVL"}
+
+
+def refresh_environment() -> Dict[str, str]:
+    """Apply pending environment changes from the .zshrc document to `local.env`.
+
+    Only the changed snippets are evaluated, in a non-interactive zsh which doesn't read any startup files, starting
+    from the current environment. The resulting difference is applied to `local.env`.
+
+    :return: changed variables
+    """
+    with ENV_LOCK:
+        script = ZSHRC.pop_environment_script()
+        if not script:
+            return {}
+
+        fd, env_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            cmd.zsh("-f", "-c", f"{script}\n{shlex.quote(sys.executable)} -c {shlex.quote(EXPORT_OS_ENVIRON_SOURCE)} {env_path}")
+            env = json.loads(Path(env_path).read_text())
+        finally:
+            os.unlink(env_path)
+
+        before = local.env.getdict()
+        changed = {
+            k: v for k, v in env.items() if k not in SHELL_STATE_VARIABLES and before.get(k) != v
+        }
+        for name in before.keys() - env.keys() - SHELL_STATE_VARIABLES:
+            del local.env[name]
+        local.env.update(**changed)
+
+    log(f"Updated environment variables {', '.join(sorted(changed))}", logging.DEBUG)
+    return changed
+
+
+@contextmanager
+def synchronised_environment():
+    """Hold `ENV_LOCK` whilst plumbum reads `local.env`, so that commands never start with a partly refreshed
+    environment"""
+    from plumbum.machines.local import LocalMachine
+
+    def synchronised(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with ENV_LOCK:
+                return method(*args, **kwargs)
+        return wrapper
+
+    original_popen, original_which = LocalMachine.__dict__["_popen"], LocalMachine.__dict__["which"]
+    LocalMachine._popen = synchronised(original_popen)
+    LocalMachine.which = classmethod(synchronised(original_which.__func__))
+    try:
+        yield
+    finally:
+        LocalMachine._popen, LocalMachine.which = original_popen, original_which
 
 
 def modifies_environment(f):
+    """Mark a function as changing the environment of .zshrc.
+
+    Inside an installer, the refresh is deferred to the next installer boundary so that several changes are applied
+    together.
+    """
     @wraps(f)
     def wrapper(*args, **kwargs):
         result = f(*args, **kwargs)
-        reload_plumbum_env()
+        if not getattr(_local, "depth", 0):
+            refresh_environment()
         return result
     return wrapper
 
 
+# Built packages #######################################################################################################
+def get_compiler_version() -> str:
+    return local["c++"]("--version").splitlines()[0]
+
+
+def get_build_key(tag: GitTag, cmake_flags: dict, sysconfig_data: SysconfigData = None, patch_url: str = None) -> str:
+    """Identify a source build by everything which determines the packages that it produces.
+
+    :param tag: tag being built
+    :param cmake_flags: CMake options of build
+    :param sysconfig_data: Python which the build links against, if any
+    :param patch_url: URL of patch applied to the sources, if any
+    :return: hex digest of build
+    """
+    python = None
+    if sysconfig_data is not None:
+        python = [
+            sysconfig_data.executable,
+            sysconfig_data.config_vars.get("py_version"),
+            sysconfig_data.config_vars.get("SOABI"),
+        ]
+    key = {
+        "tag": list(tag),
+        "cmake_options": cmake_options_from_dict(cmake_flags),
+        "python": python,
+        "compiler": get_compiler_version(),
+        "patch_url": patch_url,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@contextmanager
+def built_packages_lock():
+    """Hold an exclusive lock on the built package repository, which may be shared with other machines"""
+    BUILT_PACKAGES_PATH.mkdir(parents=True, exist_ok=True)
+    with open(BUILT_PACKAGES_PATH / ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_built_packages_manifest() -> Dict[str, Any]:
+    try:
+        return json.loads((BUILT_PACKAGES_PATH / "manifest.json").read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def find_built_packages(search_path: Path, since: float) -> List[Path]:
+    """Find the packages written under `search_path` after the time `since`"""
+    return [p for p in search_path.rglob("*.deb") if p.stat().st_mtime >= since]
+
+
+def publish_built_packages(key: str, deb_paths: List[Path], details: Dict[str, Any]):
+    """Add packages to the built package repository under the build `key`, and re-index the repository.
+
+    :param key: build key from `get_build_key`
+    :param deb_paths: paths to built packages
+    :param details: description of build, stored in the manifest
+    :return:
+    """
+    if not deb_paths:
+        log(f"No packages were found to store for build {key[:12]}", logging.WARNING)
+        return
+
+    with built_packages_lock():
+        pool_path = BUILT_PACKAGES_PATH / "pool" / key
+        pool_path.mkdir(parents=True, exist_ok=True)
+
+        packages = []
+        for deb_path in deb_paths:
+            shutil.copy2(deb_path, pool_path / deb_path.name)
+            name, version = cmd.dpkg_deb("--field", deb_path, "Package", "Version").splitlines()
+            packages.append({
+                "name": name.partition(":")[2].strip(),
+                "version": version.partition(":")[2].strip(),
+                "filename": deb_path.name,
+            })
+
+        manifest = load_built_packages_manifest()
+        manifest[key] = {"packages": packages, "created": time.time(), **details}
+
+        index = cmd.dpkg_scanpackages.with_cwd(BUILT_PACKAGES_PATH)("--multiversion", "pool", "/dev/null")
+        for name, text in (("Packages", index), ("manifest.json", json.dumps(manifest, indent=2))):
+            temp_path = BUILT_PACKAGES_PATH / f"{name}.tmp"
+            temp_path.write_text(text)
+            os.replace(temp_path, BUILT_PACKAGES_PATH / name)
+
+    log(f"Stored {len(packages)} built package(s) for build {key[:12]}")
+
+
+def register_built_packages_source():
+    source = f"deb [trusted=yes] file:{BUILT_PACKAGES_PATH.resolve()} ./\n"
+    if BUILT_PACKAGES_SOURCE_PATH.exists() and BUILT_PACKAGES_SOURCE_PATH.read_text() == source:
+        return
+    (cmd.sudo[cmd.tee[str(BUILT_PACKAGES_SOURCE_PATH)]] << source)()
+
+
+def _install_built_packages(key: str, *dpkg_flags: str) -> bool:
+    """Install the packages of a previous build from the built package repository.
+
+    :param key: build key from `get_build_key`
+    :param dpkg_flags: flags passed through to dpkg
+    :return: True if the build was found and installed, otherwise False
+    """
+    entry = load_built_packages_manifest().get(key)
+    if entry is None:
+        return False
+
+    log(f"Installing packages of build {key[:12]} from {BUILT_PACKAGES_PATH}")
+    with APT_LOCK:
+        register_built_packages_source()
+        # Only refresh the index of the local repository
+        cmd.sudo[
+            cmd.apt_get[
+                "update",
+                "-o", f"Dir::Etc::sourcelist={BUILT_PACKAGES_SOURCE_PATH}",
+                "-o", "Dir::Etc::sourceparts=-",
+                "-o", "APT::Get::List-Cleanup=0",
+            ]
+        ]()
+        pinned = [f"{p['name']}={p['version']}" for p in entry["packages"]]
+        dpkg_options = [f"-oDPkg::Options::={f}" for f in dpkg_flags]
+        (cmd.sudo[cmd.apt_get[("install", "-y", "--allow-downgrades", *dpkg_options, *pinned)]] << "\n")()
+    return True
+
+
+def _install_debs(deb_paths: List[Path], *dpkg_flags: str):
+    if not deb_paths:
+        raise FileNotFoundError("No packages were built")
+    with APT_LOCK:
+        cmd.sudo[cmd.dpkg[(*dpkg_flags, "-i", *deb_paths)]]()
+
+
+# Build jobserver #####################################################################################################
+MAKE_CLIENT_SOURCE = r'''#!/bin/sh
+# Run make as a client of the setup.py jobserver, dropping -j options so that the shared pool is used
+exec 3<>"$SETUP_JOBSERVER_FIFO"
+drop_number=
+for arg do
+    shift
+    if [ -n "$drop_number" ]; then
+        drop_number=
+        case "$arg" in
+            ''|*[!0-9]*) ;;
+            *) continue ;;
+        esac
+    fi
+    case "$arg" in
+        -j|--jobs) drop_number=1 ;;
+        -j*|--jobs=*) ;;
+        *) set -- "$@" "$arg" ;;
+    esac
+done
+# Hold a token for the implicit job slot of this make
+token=$(dd bs=1 count=1 <&3 2>/dev/null)
+MAKEFLAGS="-j --jobserver-auth=3,3" "$SETUP_JOBSERVER_MAKE" "$@"
+status=$?
+printf '%s' "$token" >&3
+exit $status
+'''
+
+
+class Jobserver:
+    """GNU make compatible jobserver, shared by all of the builds that setup.py runs.
+
+    Builds find a `make` wrapper first on their PATH, which re-opens the token FIFO (the fds of a classic jobserver
+    do not survive Python's `close_fds`), drops any -j option and runs the real make as a jobserver client. The
+    wrapper holds a token for the implicit job slot of make, so that at most `n_tokens` jobs run in total.
+    Whilst the kernel reports memory pressure, tokens are withheld from the pool.
+    """
+
+    def __init__(self, n_tokens: int):
+        self.n_tokens = n_tokens
+        STATE_PATH.mkdir(parents=True, exist_ok=True)
+        self.directory = Path(tempfile.mkdtemp(prefix="jobserver-", dir=STATE_PATH))
+        self.fifo_path = self.directory / "fifo"
+        os.mkfifo(self.fifo_path, 0o600)
+        # Keep the FIFO open for reading and writing so that tokens persist between clients
+        self._fd = os.open(self.fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(self._fd, b"+" * n_tokens)
+
+        self.bin_path = self.directory / "bin"
+        self.bin_path.mkdir()
+        make_path = self.bin_path / "make"
+        make_path.write_text(MAKE_CLIENT_SOURCE)
+        make_path.chmod(0o755)
+        self._make = shutil.which("make")
+
+        self._withheld = []
+        self._stop = threading.Event()
+        self._monitor = threading.Thread(target=self._monitor_memory_pressure, daemon=True)
+        self._monitor.start()
+
+    def environment(self) -> Dict[str, str]:
+        """Return the environment variables with which to run a build under the jobserver"""
+        return {
+            "PATH": f"{self.bin_path}:{local.env['PATH']}",
+            "SETUP_JOBSERVER_FIFO": str(self.fifo_path),
+            "SETUP_JOBSERVER_MAKE": self._make,
+        }
+
+    def _try_acquire(self) -> bytes:
+        try:
+            return os.read(self._fd, 1)
+        except BlockingIOError:
+            return b""
+
+    @contextmanager
+    def token(self):
+        """Hold a single token, for work which is not run by make"""
+        token = self._try_acquire()
+        while not token:
+            time.sleep(0.1)
+            token = self._try_acquire()
+        try:
+            yield
+        finally:
+            os.write(self._fd, token)
+
+    def _monitor_memory_pressure(self):
+        while not self._stop.wait(1.0):
+            pressure = read_pressure("memory")
+            if pressure is None:
+                return
+
+            if pressure > MEMORY_PRESSURE_HIGH and len(self._withheld) < self.n_tokens - 1:
+                token = self._try_acquire()
+                if token:
+                    self._withheld.append(token)
+                    log(f"Memory pressure {pressure:.1f}%, withholding {len(self._withheld)} build token(s)",
+                        logging.DEBUG)
+            elif pressure < MEMORY_PRESSURE_LOW and self._withheld:
+                os.write(self._fd, self._withheld.pop())
+
+    def close(self):
+        self._stop.set()
+        self._monitor.join()
+        os.close(self._fd)
+        shutil.rmtree(self.directory)
+
+
+JOBSERVER: Jobserver = None
+
+
+def read_pressure(resource: str = "memory") -> float:
+    """Return the share of the last ten seconds in which some tasks stalled on a resource, or None without PSI
+
+    :param resource: one of "cpu", "memory" or "io"
+    :return: percentage of time stalled
+    """
+    try:
+        some = Path(f"/proc/pressure/{resource}").read_text().splitlines()[0]
+    except (OSError, IndexError):
+        return None
+    return float(re.search(r"avg10=([\d.]+)", some).group(1))
+
+
+def get_build_environment() -> Dict[str, str]:
+    """Return the environment variables with which to run make-based builds"""
+    if JOBSERVER is None:
+        return {}
+    return JOBSERVER.environment()
+
+
+@contextmanager
+def build_token():
+    """Hold a jobserver token for the duration of a build which is not driven by make"""
+    if JOBSERVER is None:
+        yield
+        return
+    with JOBSERVER.token():
+        yield
+
+
 #  Installers ##########################################################################################################
 def install_pip():
     return check_output(["sudo", "apt", "install", "-y", "python3-pip"], shell=False, )
@@ -155,11 +1495,95 @@ def install_plumbum():
 
 
 def install_with_apt(*packages):
-    return (cmd.sudo[cmd.apt[("install", "-y", *packages)]] << "\n")()
+    with APT_LOCK:
+        missing = [p for p in packages if p not in _installed_apt_packages]
+        if not missing:
+            return
+
+        result = (cmd.sudo[cmd.apt[("install", "-y", *missing)]] << "\n")()
+        _installed_apt_packages.update(missing)
+        return result
+
+
+def add_apt_repository(repo, update: bool = True):
+    with APT_LOCK:
+        if repo in _added_apt_repositories:
+            return
+
+        flags = ("-y",) if update else ("-y", "-n")
+        cmd.sudo[cmd.add_apt_repository[(*flags, repo)]]()
+        _added_apt_repositories.add(repo)
+
+
+def ensure_apt_requirements(func):
+    """Install the apt repositories and packages declared by an installer with `uses_apt`"""
+    for repo in getattr(func, "apt_repositories", ()):
+        add_apt_repository(repo)
+
+    packages = getattr(func, "apt_packages", ())
+    if packages:
+        install_with_apt(*packages)
+
+
+def collect_apt_requirements(steps: List[Step]) -> Tuple[List[str], List[str]]:
+    """Return the apt repositories and packages required by a list of steps, in order of first appearance.
+
+    :param steps: list of steps
+    :return:
+    """
+    repositories = {}
+    packages = {}
+    for step in steps:
+        repositories.update(dict.fromkeys(getattr(step.func, "apt_repositories", ())))
+        packages.update(dict.fromkeys(getattr(step.func, "apt_packages", ())))
+        if step.func.__name__ == "install_with_apt":
+            packages.update(dict.fromkeys(step.args))
+    return list(repositories), list(packages)
+
+
+def preinstall_apt_packages(steps: List[Step]):
+    """Install the apt packages of all steps in a single transaction.
+
+    Repositories are added without refreshing the package index, which is then updated once. Subsequent requests
+    for these packages from the installers are no-ops.
+
+    :param steps: list of steps
+    :return:
+    """
+    repositories, packages = collect_apt_requirements(steps)
+    log(f"Installing {len(packages)} apt packages from {len(repositories)} additional repositories")
+
+    with APT_LOCK:
+        for repo in repositories:
+            add_apt_repository(repo, update=False)
+        if repositories:
+            cmd.sudo[cmd.apt["update"]]()
+        install_with_apt(*packages)
+
+
+def _install_from_wheelhouse(pip, *requirements: str):
+    """Install requirements with a single resolver pass, using only the wheels in the local wheelhouse.
+
+    If the wheelhouse cannot satisfy the requirements, the missing wheels are first downloaded (or built) into it.
+
+    :param pip: pip command of the target environment
+    :param requirements: pip requirement specifiers
+    :return:
+    """
+    WHEELHOUSE_PATH.mkdir(parents=True, exist_ok=True)
+    install = pip["install", "--no-index", "--find-links", WHEELHOUSE_PATH, *requirements]
+    if install & plumbum.TF:
+        return
+
+    with WHEELHOUSE_LOCK:
+        log(f"Adding wheels for {', '.join(requirements)} to the wheelhouse")
+        # Wheels which are already present are reused rather than downloaded again
+        pip("wheel", "--wheel-dir", WHEELHOUSE_PATH, "--find-links", WHEELHOUSE_PATH, *requirements)
+    install()
 
 
 def install_with_pip(*packages):
-    return check_output([sys.executable, "-m", "pip", "install", *packages])
+    return _install_from_wheelhouse(local[sys.executable]["-m", "pip"], *packages)
 
 
 def install_with_snap(*packages: str, classic: bool = False, beta: bool = False, edge: bool = False):
@@ -176,65 +1600,76 @@ def install_with_snap(*packages: str, classic: bool = False, beta: bool = False,
     if edge:
         packages += ("--edge",)
 
-    (cmd.sudo[cmd.snap[("install", *packages)]] << "\n")()
+    with SNAP_LOCK:
+        (cmd.sudo[cmd.snap[("install", *packages)]] << "\n")()
 
 
 def install_powerline_fonts():
-    with local.cwd("/tmp"):
-        cmd.git(
-            "clone", "https://github.com/powerline/fonts.git",
-        )
-        with local.cwd(local.cwd / "fonts"):
-            local[local.cwd / "install.sh"]()
+    cmd.git.with_cwd("/tmp")(
+        "clone", "https://github.com/powerline/fonts.git",
+    )
+    fonts_dir = local.path("/tmp/fonts")
+    local[fonts_dir / "install.sh"].with_cwd(fonts_dir)()
 
 
 @modifies_environment
 def update_path(*components: str):
-    """Update the PATH variable in .zshrc
+    """Prepend components to the PATH variable in .zshrc
 
     :param components:
     :return:
     """
-    contents = ZSHRC_PATH.read_text()
+    ZSHRC.prepend_path(*components)
 
-    def replacer(match_obj):
-        path_str = match_obj.group(1)
-        path = path_str.split(":")
-        for component in components:
-            if not component in path:
-                path.insert(0, component)
-        return f'export PATH="{":".join(path)}"'
 
-    ZSHRC_PATH.write_text(re.sub('export PATH="?([^"\n]*)"?', replacer, contents))
+def append_to_zshrc(*scripts: str, section: str = "settings"):
+    """Append scripts to a section of .zshrc
 
+    :param scripts: zsh source code
+    :param section: name of .zshrc section, see `ZshrcDocument.SECTIONS`
+    :return:
+    """
+    ZSHRC.append(section, *scripts)
 
-#@modifies_environment
-def append_to_zshrc(*scripts: str):
-    ZSHRC_PATH.touch()
-    zshrc_contents = ZSHRC_PATH.read_text()
-    if not zshrc_contents.endswith("\n"):
-        zshrc_contents += "\n"
-    zshrc_contents += "\n".join(scripts)
-    ZSHRC_PATH.write_text(zshrc_contents)
 
+@modifies_environment
+def source_in_zshrc(*scripts: str):
+    """Add scripts which modify the environment to .zshrc, before PATH is set
 
-#@modifies_environment
-def prepend_to_zshrc(*scripts: str):
-    zshrc_contents = "\n".join(scripts)
-    if not zshrc_contents.endswith("\n"):
-        zshrc_contents += "\n"
-    ZSHRC_PATH.write_text(zshrc_contents + ZSHRC_PATH.read_text())
-    reload_plumbum_env()
+    :param scripts: zsh source code
+    :return:
+    """
+    ZSHRC.append("sources", *scripts)
+
+
+@uses_apt(
+    "cmake",
+    'curl',
+    'wget',
+    "cmake-gui",
+    "build-essential",
+    "aria2",
+    "openssh-server",
+    "checkinstall",
+    "htop",
+    "lm-sensors",
+    "flameshot",
+    "libreadline-dev",
+    "libffi-dev",
+    "libsqlite3-dev",
+    "xclip",
+    "libbz2-dev",
+)
+def install_base_packages():
+    """Install common build tools and utilities"""
 
 
+@uses_apt("zsh")
 def install_zsh():
-    install_with_apt("zsh")
     cmd.sudo[cmd.chsh["-s", local.which("zsh"), os.environ['USER']]]()
-    # Enable PATH variable
-    ZSHRC_PATH.write('export PATH="$HOME/.local/bin:$PATH"')
 
     # Fix prompt formatting
-    prepend_to_zshrc(
+    append_to_zshrc(
         """
 # Hide prompt
 DEFAULT_USER=`whoami`
@@ -249,30 +1684,68 @@ setopt SHARE_HISTORY
 
 
 def install_zinit_plugins(loader, *plugins, ices=()):
-    ice_string = f"zinit ice {' '.join(ices)}\n" if ices else ""
-    plugin_strings = [f"{ice_string}zinit {loader} {p}" for p in plugins]
-    append_to_zshrc(*plugin_strings)
+    """Load zinit plugins from .zshrc.
+
+    A "${WAIT}" ice is replaced by the wait level assigned by `profile_zinit_plugins`, if the plugin was profiled.
+    Plugins without a wait ice load synchronously.
+
+    :param loader: zinit loader command (light, load, snippet)
+    :param plugins: plugin or snippet names
+    :param ices: zinit ices
+    :return:
+    """
+    profile = load_zinit_profile()
+    plugin_strings = []
+    for plugin in plugins:
+        plugin_ices = list(ices)
+        if "${WAIT}" in plugin_ices and plugin in profile:
+            plugin_ices[plugin_ices.index("${WAIT}")] = f'wait"{get_zinit_wait_level(profile[plugin])}"'
+
+        ice_string = f"zinit ice {' '.join(plugin_ices)}\n" if plugin_ices else ""
+        plugin_strings.append(f"{ice_string}zinit {loader} {plugin}")
+    append_to_zshrc(*plugin_strings, section="plugins")
 
 
+@requires("install_git", "install_zsh")
 def install_zinit():
     # Install zinit
-    cmd.sh("-c", cmd.wget("https://raw.githubusercontent.com/zdharma/zinit/master/doc/install.sh", "-O", "-"))
+    cmd.sh(download("https://raw.githubusercontent.com/zdharma/zinit/master/doc/install.sh"))
 
-    # Load required OMZ lib plugins
-    append_to_zshrc("""
-# Allow caller to disable waiting
-WAIT=${ZINIT_WAIT-wait}
-zinit ${WAIT} lucid for \
-	OMZ::lib/git.zsh \
-	OMZ::lib/completion.zsh \
-	OMZ::lib/grep.zsh \
-	OMZ::lib/directories.zsh \
-	OMZ::lib/history.zsh \
-	OMZ::lib/functions.zsh \
-	OMZ::lib/key-bindings.zsh \
-    OMZ::plugins/git/git.plugin.zsh
-
-""")
+    # Load zinit (replaces the chunk that the installer adds to .zshrc)
+    append_to_zshrc(
+        """
+source "$HOME/.zinit/bin/zinit.zsh"
+autoload -Uz _zinit
+(( ${+_comps} )) && _comps[zinit]=_zinit""",
+        section="plugins",
+    )
+
+    # Only perform the full security check of compinit (called by zpcompinit) once a day
+    append_to_zshrc(
+        """
+typeset -gA ZINIT
+() {
+  setopt local_options extended_glob
+  [[ -n $1(#qN.mh-24) ]] && ZINIT[COMPINIT_OPTS]=-C
+} ${ZDOTDIR:-$HOME}/.zcompdump"""
+    )
+
+    # Allow caller to disable waiting
+    append_to_zshrc("WAIT=${ZINIT_WAIT-wait}", section="plugins")
+
+    # Load required OMZ lib plugins, individually so that each may be assigned its own wait level
+    install_zinit_plugins(
+        "snippet",
+        "OMZ::lib/git.zsh",
+        "OMZ::lib/completion.zsh",
+        "OMZ::lib/grep.zsh",
+        "OMZ::lib/directories.zsh",
+        "OMZ::lib/history.zsh",
+        "OMZ::lib/functions.zsh",
+        "OMZ::lib/key-bindings.zsh",
+        "OMZ::plugins/git/git.plugin.zsh",
+        ices=("${WAIT}", "lucid"),
+    )
 
     # Load non-startup essential OMZ plugins
     install_zinit_plugins(
@@ -308,10 +1781,11 @@ zinit ${WAIT} lucid for \
 # OMZ take command
 function tkdir() {
   mkdir -p $@ && cd ${@:$#}
-}"""
+}""",
+        section="aliases",
     )
 
-    cmd.wget('https://gist.githubusercontent.com/agoose77/f954a564b6da70bbcc9f9ff5ae36a9c5/raw', '-O', local.path('~/.p10k.zsh'))
+    download('https://gist.githubusercontent.com/agoose77/f954a564b6da70bbcc9f9ff5ae36a9c5/raw', HOME_PATH / '.p10k.zsh')
     append_to_zshrc('POWERLEVEL9K_DISABLE_CONFIGURATION_WIZARD=true')
     install_zinit_plugins(
         "light",
@@ -324,31 +1798,34 @@ function tkdir() {
         ),
     )
     # Add instant prompt
-    prepend_to_zshrc("""
+    append_to_zshrc("""
 # Enable Powerlevel10k instant prompt. Should stay close to the top of ~/.zshrc.
 # Initialization code that may require console input (password prompts, [y/n]
 # confirmations, etc.) must go above this block; everything else may go below.
 if [[ -r "${XDG_CACHE_HOME:-$HOME/.cache}/p10k-instant-prompt-${(%):-%n}.zsh" ]]; then
   source "${XDG_CACHE_HOME:-$HOME/.cache}/p10k-instant-prompt-${(%):-%n}.zsh"
 fi
-    """)
-    # Finalise p10k. TODO - maintain representation of prep/app order in source to support ordering
-    append_to_zshrc("(( ! ${+functions[p10k]} )) || p10k finalize")
+    """, section="header")
+    # Finalise p10k
+    append_to_zshrc("(( ! ${+functions[p10k]} )) || p10k finalize", section="footer")
 
 
+@requires("install_zsh")
+@uses_apt("fd-find")
 def install_fd():
-    install_with_apt("fd-find")
     append_to_zshrc(
         """
 # Fd-find alias
 alias fd='fdfind'
-"""
+""",
+        section="aliases",
     )
 
 
+@requires("install_zinit")
+@uses_apt("tmux")
 def install_tmux():
-    install_with_apt("tmux")
-    cmd.wget(TMUX_CONF_URL, "-O", HOME_PATH / ".tmux.conf")
+    download(TMUX_CONF_URL, HOME_PATH / ".tmux.conf")
 
     # Load non-startup essential ZSH plugin
     install_zinit_plugins(
@@ -357,27 +1834,24 @@ def install_tmux():
 
 
 def install_chrome():
-    deb_name = "google-chrome-stable_current_amd64.deb"
-    with local.cwd("/tmp"):
-        cmd.wget(f"https://dl.google.com/linux/direct/{deb_name}")
-        cmd.sudo[cmd.dpkg["-i", deb_name]]()
+    deb_path = download("https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb")
+    with APT_LOCK:
+        cmd.sudo[cmd.dpkg["-i", deb_path]]()
 
 
+@uses_apt("numix-icon-theme-circle", repositories=('ppa:numix/ppa',))
 def install_numix_theme():
-    add_add_apt_repositoryppa('ppa:numix/ppa')
-    cmd.sudo[cmd.apt["update"]]()
-    install_with_apt("numix-icon-theme-circle")
+    """Install the Numix circle icon theme"""
 
 
 def install_canta_theme():
     install_numix_theme()
 
-    with local.cwd("/tmp"):
-        cmd.git(
-            "clone", "https://github.com/vinceliuice/Canta-theme.git",
-        )
-        with local.cwd("Canta-theme"):
-            local[local.cwd / "install.sh"]("-i")
+    cmd.git.with_cwd("/tmp")(
+        "clone", "https://github.com/vinceliuice/Canta-theme.git",
+    )
+    theme_dir = local.path("/tmp/Canta-theme")
+    local[theme_dir / "install.sh"].with_cwd(theme_dir)("-i")
 
     cmd.gsettings(
         "set", "org.gnome.desktop.interface", "icon-theme", "Canta",
@@ -390,12 +1864,14 @@ def install_canta_theme():
     )
 
 
+@uses_apt("gnome-tweak-tool")
 def install_gnome_tweak_tool():
-    (cmd.sudo[cmd.apt["install", "gnome-tweak-tool"]] << "\n")()
+    """Install the GNOME tweak tool"""
 
 
+@requires("install_chrome")
+@uses_apt("chrome-gnome-shell")
 def install_gnome_theme():
-    install_with_apt("chrome-gnome-shell")
     cmd.google_chrome(
         "https://chrome.google.com/webstore/detail/gnome-shell-integration/"
         "gphhapmejobijbbhgpjhcjognlahblep?utm_source=inline-install-disabled"
@@ -404,24 +1880,7 @@ def install_gnome_theme():
 
 
 def install_pandoc(github_token: str):
-    query = """
-{
-  repository(owner: "jgm", name: "pandoc") {
-    releases(first: 1, orderBy: {field: CREATED_AT, direction: DESC}) {
-      nodes {
-        name
-        releaseAssets(first: 10) {
-          nodes{
-            name
-            contentType
-            downloadUrl
-          }
-        }
-      }
-    }
-  }
-}
-  """
+    query = f"{{{make_github_repository_query('jgm', 'pandoc', GITHUB_LATEST_RELEASE_FIELDS)}}}"
     result = execute_github_graphql_query(github_token, query)
     (release,) = result["data"]["repository"]["releases"]["nodes"]
 
@@ -431,34 +1890,32 @@ def install_pandoc(github_token: str):
         if n["name"].endswith(".deb")
     )
     log(f"Found {release['name']}, downloading deb from {deb_url}")
+    record_installed_version("pandoc", release["name"])
 
-    with local.cwd("/tmp"):
-        with detect_changed_files(local.cwd) as changed_files:
-            cmd.aria2c(deb_url, "-j", "10", "-x", "10")
-        (deb_path,) = changed_files
-        install_with_apt(deb_path)
+    install_with_apt(str(download(deb_url)))
 
 
+@requires("install_zsh")
 def install_tex():
-    with local.cwd("/tmp"):
-        cmd.wget("mirror.ctan.org/systems/texlive/tlnet/install-tl-unx.tar.gz")
-        cmd.tar("-xvf", "install-tl-unx.tar.gz")
-
-        directory = next((p for p in (local.cwd // "install-tl*") if p.is_dir()))
-
-        path_component = None
-        pattern = re.compile(r"Most importantly, add (.*)")
-
-        with local.cwd(directory):
-            proc = (cmd.sudo[local[local.cwd / "install-tl"]] << "I\n").popen()
-            for out, err in proc:
-                if err:
-                    log(err, logging.ERROR)
-                if out:
-                    log(out, logging.INFO)
-                    match = pattern.match(out)
-                    if match:
-                        path_component = match.group(1)
+    temp_dir = local.path(tempfile.mkdtemp())
+    archive_path = download("https://mirror.ctan.org/systems/texlive/tlnet/install-tl-unx.tar.gz")
+    cmd.tar.with_cwd(temp_dir)("-xvf", archive_path)
+
+    directory = next((p for p in (temp_dir // "install-tl*") if p.is_dir()))
+
+    path_component = None
+    pattern = re.compile(r"Most importantly, add (.*)")
+
+    with build_token():
+        proc = (cmd.sudo[local[directory / "install-tl"]].with_cwd(directory) << "I\n").popen()
+        for out, err in proc:
+            if err:
+                log(err, logging.ERROR)
+            if out:
+                log(out, logging.INFO)
+                match = pattern.match(out)
+                if match:
+                    path_component = match.group(1)
 
     if path_component is not None:
         update_path(path_component)
@@ -470,12 +1927,11 @@ def get_system_python_version() -> str:
     return f"{version_info.major}.{version_info.minor}.{version_info.micro}"
 
 
+@uses_apt("python3-venv")
 def install_pyenv_sys_python(system_venv_name: str):
     """
     Install the system Python into pyenv's versions directory using venv
     """
-    install_with_apt("python3-venv")
-
     # Create venv
     pyenv_root = local.env.home / ".pyenv"
     pyenv_versions_dir = pyenv_root / "versions"
@@ -488,37 +1944,35 @@ def install_pyenv_sys_python(system_venv_name: str):
     # Produce shims for pip, python (required when they don't exist and we dont call into pyenv init)
     cmd.pyenv("rehash")
 
-    with local.env(PYENV_VERSION=system_venv_name):
-        # Install some utilities
-        cmd.pip(
-            "install", "nbdime", "jupyter", "jupyterlab", "jupyter-console", "makey",
-        )
+    # Install some utilities
+    _install_from_wheelhouse(
+        cmd.pip.with_env(PYENV_VERSION=system_venv_name),
+        "nbdime", "jupyter", "jupyterlab", "jupyter-console", "makey",
+    )
 
-        # Setup nbdime as git diff engine
-        cmd.nbdime("config-git", "--enable", "--global")
+    # Setup nbdime as git diff engine
+    cmd.nbdime.with_env(PYENV_VERSION=system_venv_name)("config-git", "--enable", "--global")
 
     append_to_zshrc(
         'alias jc="jupyter console"',
         'alias jl="jupyter lab"',
         'alias jle="jupyter labextension"',
+        section="aliases",
     )
 
 
+@requires("install_git", "install_zinit")
+# Declare the packages of the nested installer so that they are collected into the same transaction
+@uses_apt(*install_pyenv_sys_python.apt_packages)
 def install_pyenv(system_venv_name: str):
     """
     Install PyEnv for managing Python versions & virtualenvs
     :return:
     """
     # Install pyenv
-    (
-            cmd.wget[
-                "-O",
-                "-",
-                "https://github.com/pyenv/pyenv-installer/raw/master/bin/pyenv-installer",
-            ]
-            | cmd.bash
-    )()
-    update_path("$HOME/.pyenv/bin")
+    cmd.bash(download("https://github.com/pyenv/pyenv-installer/raw/master/bin/pyenv-installer"))
+    # Shims are also added by the pyenv plugin, but must be visible to subsequent installers
+    update_path("$HOME/.pyenv/bin", "$HOME/.pyenv/shims")
 
     # Load non-startup essential plugin
     install_zinit_plugins(
@@ -527,76 +1981,259 @@ def install_pyenv(system_venv_name: str):
     install_pyenv_sys_python(system_venv_name)
 
 
-def install_development_virtualenv(python_version: str, virtualenv_name: str = None):
+def get_python_build_archive_path(python_version: str, configure_opts: List[str], prefix: Path) -> Path:
+    # The prefix is part of the key, as the interpreter is linked against libpython by its absolute path
+    key_data = json.dumps(
+        {
+            "version": python_version,
+            "configure_opts": configure_opts,
+            "os": read_os_release(),
+            "machine": os.uname().machine,
+            "prefix": str(prefix),
+        }
+    )
+    key = hashlib.sha256(key_data.encode()).hexdigest()[:16]
+    return PYTHON_BUILD_CACHE_PATH / f"{python_version}-{key}.tar.gz"
+
+
+def ensure_pyenv_python(python_version: str, n_threads: int):
+    """
+    Build a Python interpreter with pyenv, or unpack an identical earlier build from the cache.
+
+    Only CPython source builds (plain X.Y.Z versions) are cached; other versions, such as `miniconda3-latest`, are
+    resolved by pyenv at install time, so an archive of them would go stale.
+    :param python_version: Python interpreter version string
+    :param n_threads: number of threads to use for compiling
+    :return:
+    """
+    pyenv_versions_dir = Path(local.env.home) / ".pyenv" / "versions"
+    prefix = pyenv_versions_dir / python_version
+    if prefix.exists():
+        log(f"Python {python_version} is already installed")
+        return
+
+    configure_opts = ["--enable-shared"]
+    if PYTHON_OPTIMIZED_BUILD:
+        configure_opts += ["--enable-optimizations", "--with-lto"]
+
+    # MAKE_OPTS only applies without the jobserver, whose make wrapper ignores -j
+    pyenv_install = cmd.pyenv["install", python_version].with_env(
+        PYTHON_CONFIGURE_OPTS=" ".join(configure_opts), MAKE_OPTS=f"-j{n_threads}", **get_build_environment()
+    )
+    if not re.fullmatch(r"\d+\.\d+\.\d+", python_version):
+        pyenv_install()
+        return
+
+    archive_path = get_python_build_archive_path(python_version, configure_opts, prefix)
+    if archive_path.exists():
+        log(f"Unpacking Python {python_version} from {archive_path}")
+        pyenv_versions_dir.mkdir(parents=True, exist_ok=True)
+        cmd.tar("-xzf", archive_path, "-C", pyenv_versions_dir)
+        cmd.pyenv("rehash")
+        return
+
+    pyenv_install()
+
+    PYTHON_BUILD_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    temp_path = archive_path.with_suffix(".tmp")
+    cmd.tar("-czf", temp_path, "-C", pyenv_versions_dir, python_version)
+    os.replace(temp_path, archive_path)
+
+
+@requires("install_pyenv")
+@uses_apt("npm")
+def install_development_virtualenv(python_version: str, virtualenv_name: str = None, n_threads: int = 1):
     """
     Install Jupyter within a new virtual environment
 
     :param python_version: Python interpreter version string
     :param virtualenv_name: Name of virtual environment
+    :param n_threads: number of threads to use if the interpreter is compiled
     :return:
     """
-    # Install npm
-    install_with_apt("npm")
-
     if not python_version:
         python_version = get_system_python_version()
 
     # Install a particular interpreter (from source)
     if python_version != get_system_python_version():
         log("Installing Python version")
-        cmd.pyenv["install", python_version].with_env(
-            PYTHON_CONFIGURE_OPTS="--enable-shared"
-        )()
+        ensure_pyenv_python(python_version, n_threads)
 
     # Create virtualenv
     log("Creating virtualenv")
     cmd.pyenv("virtualenv", python_version, virtualenv_name)
 
     # Install packages
-    with local.env(PYENV_VERSION=virtualenv_name):
-        log("Installing jupyter packages with pip")
-        cmd.pip(
-            "install",
-            "jupyter",
-            "jupyterlab",
-            "matplotlib",
-            "ipympl",
-            "numpy-html",
-            "jupytex",
-            "numba",
-        )
+    requirements = [
+        "jupyter",
+        "jupyterlab",
+        "matplotlib",
+        "ipympl",
+        "numpy-html",
+        "jupytex",
+        "numba",
+    ]
 
-        # Conda for scientific libraries
-        try:
-            conda = get_conda(virtualenv_name)
-        except FileNotFoundError:
-            cmd.pip("install", "scipy", "numpy")
+    # Without conda, the scientific libraries are resolved alongside the other packages (see `install_conda_packages`)
+    try:
+        get_conda(virtualenv_name)
+    except FileNotFoundError:
+        requirements += ["scipy", "numpy"]
+
+    log("Installing jupyter packages with pip")
+    _install_from_wheelhouse(cmd.pip.with_env(PYENV_VERSION=virtualenv_name), *requirements)
+
+    # Install labextensions
+    log("Installing lab extensions")
+    register_labextensions(
+        virtualenv_name,
+        "@jupyter-widgets/jupyterlab-manager",
+        "jupyter-matplotlib",
+       # "bqplot",
+        "@agoose77/jupyterlab-markup",
+       # "@telamonian/theme-darcula",
+        "@jupyterlab/katex-extension",
+    )
+
+
+@requires("install_development_virtualenv")
+def install_conda_packages(virtualenv_name: str, *specs: str):
+    """
+    Install the conda packages of every installer in one transaction, if conda is available in the virtual environment
+    :param virtualenv_name: name of PyEnv environment to install into
+    :param specs: conda package specifications, from `get_conda_requests`
+    :return:
+    """
+    try:
+        conda = get_conda(virtualenv_name)
+    except FileNotFoundError:
+        log("Conda is not available, skipping conda packages")
+        return
+
+    _install_with_conda(conda, *specs)
+
+
+def time_first_imports(python, modules, n_runs: int = 5) -> Dict[str, float]:
+    """Time the import of each module in a new interpreter, without writing bytecode so that the timing is repeatable
+
+    :param python: Python command of the environment
+    :param modules: names of modules to import
+    :param n_runs: number of timed imports of each module, after an untimed import which warms the page cache
+    :return: median import time in seconds of each module which could be imported
+    """
+    import statistics
+
+    timings = {}
+    for module in modules:
+        durations = []
+        for _ in range(n_runs + 1):
+            retcode, stdout, _ = python.run(("-B", "-c", FIRST_IMPORT_TIME_SOURCE, module), retcode=None)
+            if retcode or not stdout.strip():
+                break
+            durations.append(float(stdout))
         else:
-            conda("install", "scipy", "numpy")
-
-        # Install labextensions
-        log("Installing lab extensions")
-        cmd.jupyter(
-            "labextension",
-            "install",
-            "@jupyter-widgets/jupyterlab-manager",
-            "jupyter-matplotlib",
-           # "bqplot",
-            "@agoose77/jupyterlab-markup",
-           # "@telamonian/theme-darcula",
-            "@jupyterlab/katex-extension",
-        )
+            timings[module] = statistics.median(durations[1:])
+    return timings
+
+
+@requires("install_pyenv", "install_development_virtualenv", "install_conda_packages", "install_root")
+def install_precompiled_bytecode(*virtualenv_names: str):
+    """
+    Compile the bytecode of every module in the site-packages of the virtual environments, using all cores, so that it
+    is not compiled on first import
+    :param virtualenv_names: names of PyEnv environments to compile
+    :return:
+    """
+    for virtualenv_name in virtualenv_names:
+        python = cmd.python.with_env(PYENV_VERSION=virtualenv_name)
+        sysconfig_data = get_pyenv_sysconfig_data(virtualenv_name)
+        site_packages = sorted({sysconfig_data.paths["purelib"], sysconfig_data.paths["platlib"]})
+
+        before = time_first_imports(python, FIRST_IMPORT_MODULES)
+        log(f"Compiling bytecode in {', '.join(site_packages)}")
+        retcode, _, stderr = python.run(("-m", "compileall", "-q", "-j0", *site_packages), retcode=None)
+        if retcode:
+            # Packages may ship files which are not valid for this interpreter, such as templates or test data
+            log(f"Some modules could not be compiled:\n{stderr}", level=logging.WARN)
+        after = time_first_imports(python, FIRST_IMPORT_MODULES)
+
+        for module, before_time in before.items():
+            after_time = after.get(module, before_time)
+            log(
+                f"{virtualenv_name}: import {module} took a median of {before_time * 1e3:.0f} ms before, "
+                f"{after_time * 1e3:.0f} ms after ({(before_time - after_time) * 1e3:.0f} ms saved)"
+            )
+
+
+def register_labextensions(virtualenv_name: str, *extensions: str):
+    """Add extensions to JupyterLab without rebuilding it; the assets are built once by `install_jupyterlab_build`
+
+    :param virtualenv_name: name of PyEnv environment which provides JupyterLab
+    :param extensions: npm package names of the extensions
+    :return:
+    """
+    cmd.jupyter.with_env(PYENV_VERSION=virtualenv_name)("labextension", "install", "--no-build", *extensions)
 
 
+def get_jupyterlab_build_key(version: str, app_path: Path) -> str:
+    """Return a key which identifies the JupyterLab assets built for this version and set of extensions
+
+    :param version: JupyterLab version string
+    :param app_path: JupyterLab application directory
+    :return:
+    """
+    # Extension tarballs are named after the package and its version
+    extensions = sorted(p.name for p in (app_path / "extensions").glob("*.tgz"))
+    build_config_path = app_path / "settings" / "build_config.json"
+    build_config = build_config_path.read_text() if build_config_path.exists() else ""
+    key_data = json.dumps({"version": version, "extensions": extensions, "build_config": build_config})
+    return hashlib.sha256(key_data.encode()).hexdigest()[:16]
+
+
+@requires("install_development_virtualenv", "install_root")
+def install_jupyterlab_build(virtualenv_name: str):
+    """
+    Build the JupyterLab assets for the registered extensions, or restore an identical build from the cache
+    :param virtualenv_name: name of PyEnv environment which provides JupyterLab
+    :return:
+    """
+    app_info = json.loads(cmd.python.with_env(PYENV_VERSION=virtualenv_name)("-c", JUPYTERLAB_APP_SOURCE))
+    app_path = Path(app_info["app_dir"])
+    static_path = app_path / "static"
+    cached_path = JUPYTERLAB_BUILD_CACHE_PATH / get_jupyterlab_build_key(app_info["version"], app_path)
+
+    if cached_path.exists():
+        log(f"Restoring JupyterLab build from {cached_path}")
+        shutil.rmtree(static_path, ignore_errors=True)
+        shutil.copytree(cached_path, static_path)
+        return
+
+    # Minimisation dominates the memory use of the build, so it is skipped
+    log("Building JupyterLab")
+    with build_token():
+        cmd.jupyter.with_env(PYENV_VERSION=virtualenv_name)("lab", "build", "--dev-build=False", "--minimize=False")
+
+    # Copy and then rename, so that an interrupted copy is never used
+    JUPYTERLAB_BUILD_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    partial_path = Path(tempfile.mkdtemp(dir=JUPYTERLAB_BUILD_CACHE_PATH)) / "static"
+    shutil.copytree(static_path, partial_path)
+    try:
+        partial_path.rename(cached_path)
+    except OSError:
+        # Another environment stored the same build first
+        pass
+    shutil.rmtree(partial_path.parent, ignore_errors=True)
+
+
+@requires("install_zsh")
 def install_micro():
     """
     Install the micro editor
     :return:
     """
     # Set default editor in ZSH
-    with local.cwd('/tmp'):
-        (cmd.curl['https://getmic.ro'] | cmd.bash)()
-        cmd.sudo[cmd.mv['micro', '/usr/local/bin']]()
+    cmd.bash.with_cwd('/tmp')(download('https://getmic.ro'))
+    cmd.sudo[cmd.mv['micro', '/usr/local/bin']].with_cwd('/tmp')()
     append_to_zshrc("""export EDITOR=micro
 export MICRO_TRUECOLOR=1 
     """)
@@ -604,11 +2241,10 @@ export MICRO_TRUECOLOR=1
     # Install colourscheme
     theme_dir = local.path('~/.config/micro/colorschemes')
     theme_dir.mkdir()
-    cmd.wget('https://gist.githubusercontent.com/agoose77/73d4c5b5a540535a200882bf5dd0131d/raw', '-O', theme_dir / 'ayu-micrage.micro')
+    download('https://gist.githubusercontent.com/agoose77/73d4c5b5a540535a200882bf5dd0131d/raw', theme_dir / 'ayu-micrage.micro')
 
+@uses_apt("xdotool")
 def install_keyboard_shortcuts():
-    install_with_apt("xdotool")
-
     custom_bindings = [
         ("Screenshot area with Flameshot", "flameshot gui", "Print",),
         ("Spotify", "spotify", "<Super>s"),
@@ -702,33 +2338,36 @@ def create_gpg_key(name, email_address, key_length):
     return gpg.export_keys(signing_key), signing_key
 
 
+@requires("install_zsh")
 def install_git_shortcuts():
     append_to_zshrc(
         "# TODO tracking",
         "alias todo='git grep --no-pager  -EI \"TODO|FIXME\"'",
         "alias td='todo'",
+        section="aliases",
     )
 
 
+@requires("install_zinit")
+@uses_apt("git-flow")
 def install_git_flow():
-    install_with_apt("git-flow")
     install_zinit_plugins(
         "snippet", "OMZ::plugins/git-flow/git-flow.plugin.zsh", ices=("${WAIT}", "lucid"),
     )
     install_zinit_plugins("light", "bobthecow/git-flow-completion", ices=("${WAIT}", "lucid"))
 
 
+@uses_apt("git", "git-lfs")
 def install_git(name, email_address):
-    install_with_apt("git", "git-lfs")
-
     cmd.git("config", "--global", "user.email", email_address)
     cmd.git("config", "--global", "user.name", name)
 
     make_or_find_git_dir()
 
 
+@requires("install_base_packages", "install_git", "install_zsh", "install_chrome")
+@uses_apt("gnupg")
 def install_gnupg(name, email_address, key_length):
-    install_with_apt("gnupg")
     install_with_pip("gnupg")
     # Create public key and copy to clipboard
     public_key, signing_key = create_gpg_key(name, email_address, key_length)
@@ -791,51 +2430,179 @@ def graphql_errors_to_string(errors):
     messages = []
     for error in errors:
         locations = [
-            f'(line {p["line"]}, column {p["column"]})' for p in error["locations"]
+            f'(line {p["line"]}, column {p["column"]})' for p in error.get("locations", [])
         ]
         messages.append(f'{error["message"]} on {", ".join(locations)}')
     return "\n".join(messages)
 
 
-def execute_github_graphql_query(token: str, query: str) -> dict:
-    import urllib.request as request
-    import urllib.error as error
+# Fields of a GitHub repository object which are used by the installers
+GITHUB_LATEST_TAG_FIELDS = """
+        refs(refPrefix: "refs/tags/", first: 1, orderBy: {field: ALPHABETICAL, direction: DESC}) {
+          edges {
+            node {
+              name
+              target {
+                __typename
+                ... on Tag {
+                  name
+                  target {
+                    ... on Commit {
+                      tarballUrl
+                    }
+                  }
+                }
+                ... on Commit {
+                  tarballUrl
+                }
+              }
+            }
+          }
+        }
+"""
+GITHUB_LATEST_RELEASE_FIELDS = """
+    releases(first: 1, orderBy: {field: CREATED_AT, direction: DESC}) {
+      nodes {
+        name
+        releaseAssets(first: 10) {
+          nodes{
+            name
+            contentType
+            downloadUrl
+          }
+        }
+      }
+    }
+"""
+# Lookups which are resolved together in a single request, by alias
+GITHUB_PREFETCH_QUERIES = {
+    "root": ("root-project", "root", GITHUB_LATEST_TAG_FIELDS),
+    "geant4": ("Geant4", "geant4", GITHUB_LATEST_TAG_FIELDS),
+    "pandoc": ("jgm", "pandoc", GITHUB_LATEST_RELEASE_FIELDS),
+}
+
+_github_connection = None
+GITHUB_CONNECTION_LOCK = threading.Lock()
 
-    req = request.Request(
-        "https://api.github.com/graphql",
-        method="POST",
-        data=json.dumps({"query": query}).encode(),
-        headers={"Authorization": f"token {token}"},
-    )
 
+def make_github_repository_query(owner: str, name: str, fields: str, alias: str = None) -> str:
+    alias_string = f"{alias}: " if alias else ""
+    return f'{alias_string}repository(owner: "{owner}", name: "{name}") {{{fields}}}'
+
+
+def get_github_cache_path(token: str, query: str) -> Path:
+    # Responses are keyed by token as well, so that a cached response never validates a different token
+    key = hashlib.sha256(f"{token}\n{query}".encode()).hexdigest()
+    return GITHUB_CACHE_PATH / f"{key}.json"
+
+
+def store_github_response(token: str, query: str, result: dict):
+    GITHUB_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    cache_path = get_github_cache_path(token, query)
+    temp_path = cache_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(result))
+    os.replace(temp_path, cache_path)
+
+
+def post_github_graphql_query(token: str, query: str) -> Tuple[int, bytes]:
+    """POST a query to the GraphQL endpoint over a kept-alive connection, which is shared between requests.
+
+    :param token: GitHub personal access token
+    :param query: GraphQL query
+    :return: status code and body of response
+    """
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+
+    global _github_connection
+
+    url = urlsplit(GITHUB_GRAPHQL_URL)
+    body = json.dumps({"query": query}).encode()
+    headers = {
+        "Authorization": f"token {token}",
+        "Content-Type": "application/json",
+        "User-Agent": "setup.py",
+    }
+
+    with GITHUB_CONNECTION_LOCK:
+        for attempt in range(2):
+            if _github_connection is None:
+                connection_type = HTTPSConnection if url.scheme == "https" else HTTPConnection
+                _github_connection = connection_type(url.netloc, timeout=60)
+            try:
+                _github_connection.request("POST", url.path or "/", body, headers)
+                response = _github_connection.getresponse()
+                return response.status, response.read()
+            except (HTTPException, OSError):
+                # The server may have closed the idle connection, so reconnect once
+                _github_connection.close()
+                _github_connection = None
+                if attempt:
+                    raise
+
+
+def execute_github_graphql_query(token: str, query: str) -> dict:
+    """Execute a GraphQL query, using a cached response if one is younger than `GITHUB_CACHE_TTL`.
+
+    :param token: GitHub personal access token
+    :param query: GraphQL query
+    :return:
+    """
+    cache_path = get_github_cache_path(token, query)
     try:
-        resp = request.urlopen(req)
-    except error.HTTPError as err:
-        if err.code == 401:
-            raise TokenInvalidError(f"Token {token!r} was invalid!") from err
-        raise
+        if time.time() - cache_path.stat().st_mtime < GITHUB_CACHE_TTL:
+            return json.loads(cache_path.read_text())
+    except (FileNotFoundError, ValueError):
+        pass
+
+    status, body = post_github_graphql_query(token, query)
+    if status == 401:
+        raise TokenInvalidError(f"Token {token!r} was invalid!")
+    if status >= 400:
+        raise OSError(f"GitHub API request failed with status {status}: {body[:200]!r}")
 
-    result = json.loads(resp.read())
+    result = json.loads(body)
     if "errors" in result:
         raise ValueError(graphql_errors_to_string(result["errors"]))
+
+    store_github_response(token, query, result)
     return result
 
 
+def prefetch_github_queries(token: str):
+    """Resolve all of `GITHUB_PREFETCH_QUERIES` in a single aliased query.
+
+    The result for each alias is cached as the response to the equivalent single-repository query, so that later
+    lookups don't make any requests.
+
+    :param token: GitHub personal access token
+    :return:
+    """
+    queries = {
+        alias: f"{{{make_github_repository_query(owner, name, fields)}}}"
+        for alias, (owner, name, fields) in GITHUB_PREFETCH_QUERIES.items()
+    }
+    cache_paths = [get_github_cache_path(token, q) for q in queries.values()]
+    if all(p.exists() and time.time() - p.stat().st_mtime < GITHUB_CACHE_TTL for p in cache_paths):
+        return
+
+    batch_query = "{\n%s\n}" % "\n".join(
+        make_github_repository_query(owner, name, fields, alias)
+        for alias, (owner, name, fields) in GITHUB_PREFETCH_QUERIES.items()
+    )
+    result = execute_github_graphql_query(token, batch_query)
+    for alias, query in queries.items():
+        store_github_response(token, query, {"data": {"repository": result["data"][alias]}})
+
+
 def validate_github_token(token: str) -> str:
     """
-    Test GitHub token to ensure it is valid.
+    Test GitHub token to ensure it is valid, prefetching the release and tag lookups in the same request.
 
     :param token: GitHub personal access token
     :return: GitHub personal access token
     """
-    test_query = """
-    {
-          repository(owner:"root-project", name: "root") {
-            name
-          }
-    }
-    """
-    execute_github_graphql_query(token, test_query)
+    prefetch_github_queries(token)
     return token
 
 
@@ -848,36 +2615,7 @@ def find_latest_github_tag(token: str, owner: str, name: str) -> GitTag:
     :param name: Repository name
     :return:
     """
-    from string import Template
-
-    query_template = """
-{
-    repository(owner:"$owner", name: "$name") {
-        refs(refPrefix: "refs/tags/", first: 1, orderBy: {field: ALPHABETICAL, direction: DESC}) {
-          edges {
-            node {
-              name
-              target {
-                __typename
-                ... on Tag {
-                  name
-                  target {
-                    ... on Commit {
-                      tarballUrl
-                    }
-                  }
-                }
-                ... on Commit {
-                  tarballUrl
-                }
-              }
-            }
-          }
-        }
-    }
-}
-    """
-    query = Template(query_template).substitute(owner=owner, name=name)
+    query = f"{{{make_github_repository_query(owner, name, GITHUB_LATEST_TAG_FIELDS)}}}"
     result = execute_github_graphql_query(token, query)
 
     (edge,) = result["data"]["repository"]["refs"]["edges"]
@@ -925,10 +2663,121 @@ def get_conda(virtualenv_name=None):
     return shim
 
 
+def get_conda_requests(use_root: bool) -> List[str]:
+    """Return the package specifications which are installed with conda, when it is available
+
+    :param use_root: whether to install ROOT from conda-forge
+    :return:
+    """
+    requests = ["scipy", "numpy"]
+    if use_root:
+        # Qualify the channel per package, so that the other packages are still solved from the default channels
+        requests.append("conda-forge::root")
+    return requests
+
+
+def get_conda_lockfile_path(conda, specs: Tuple[str, ...]) -> Path:
+    # The same request against the same starting environment and platform resolves to the same packages
+    environment = conda("list", "--explicit")
+    key_data = json.dumps({"specs": sorted(specs), "environment": environment})
+    return CONDA_LOCKFILE_CACHE_PATH / f"{hashlib.sha256(key_data.encode()).hexdigest()}.txt"
+
+
+def _install_with_conda(conda, *specs: str):
+    """Install packages in a single conda transaction, reusing the explicit lockfile of an identical earlier solve.
+
+    :param conda: conda command of the target environment
+    :param specs: conda package specifications
+    :return:
+    """
+    lockfile_path = get_conda_lockfile_path(conda, specs)
+    if lockfile_path.exists():
+        log(f"Installing conda packages from {lockfile_path}")
+        conda("install", "--yes", "--file", lockfile_path)
+        return
+
+    solver_args = [f"--solver={CONDA_SOLVER}"] if CONDA_SOLVER else []
+    conda("install", "--yes", *solver_args, *specs)
+
+    # Only explicit lists (URLs of the exact packages) may be installed without solving
+    lockfile = conda("list", "--explicit", "--md5")
+    if "@EXPLICIT" not in lockfile:
+        return
+    CONDA_LOCKFILE_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    temp_path = lockfile_path.with_suffix(".tmp")
+    temp_path.write_text(lockfile)
+    os.replace(temp_path, lockfile_path)
+
+
 def cmake_options_from_dict(opts):
     return [f"D{f}={v}" for f, v in opts.items()]
 
 
+# Compile through ccache, via CMake's launcher support
+CCACHE_CMAKE_FLAGS = {
+    "CMAKE_C_COMPILER_LAUNCHER": "ccache",
+    "CMAKE_CXX_COMPILER_LAUNCHER": "ccache",
+}
+
+
+@contextmanager
+def compiler_cache():
+    """Prepare the persistent ccache directory, and log the hit/miss statistics of the build on exit.
+
+    :return: environment variables with which to run the build
+    """
+    CCACHE_PATH.mkdir(parents=True, exist_ok=True)
+    env = {
+        "CCACHE_DIR": str(CCACHE_PATH),
+        # Sources are extracted into a directory named after the tag, so hash paths relative to it
+        # in order that nearby tags share cache entries
+        "CCACHE_BASEDIR": str(make_or_find_libraries_dir()),
+        "CCACHE_NOHASHDIR": "1",
+        "CCACHE_SLOPPINESS": "time_macros,include_file_mtime,include_file_ctime",
+    }
+    ccache = cmd.ccache.with_env(**env)
+    ccache("--max-size", CCACHE_MAX_SIZE)
+    ccache("--zero-stats")
+    try:
+        yield env
+    finally:
+        log_ccache_stats(ccache)
+
+
+def log_ccache_stats(ccache):
+    """Log a hit/miss summary of the compilations since the statistics were zeroed, and the full statistics at DEBUG"""
+    retcode, stdout, _ = ccache["--print-stats"].run(retcode=None)
+    stats = {}
+    for line in stdout.splitlines():
+        name, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[name] = int(value)
+
+    # Machine-readable statistics require ccache 3.7, otherwise show the report instead
+    if retcode or "cache_miss" not in stats:
+        for line in ccache("--show-stats").splitlines():
+            log(line)
+        return
+
+    n_hits = stats.get("direct_cache_hit", 0) + stats.get("preprocessed_cache_hit", 0)
+    n_misses = stats["cache_miss"]
+    hit_rate = n_hits / (n_hits + n_misses) if n_hits + n_misses else 0.0
+    log(f"ccache: {n_hits} hits, {n_misses} misses ({hit_rate:.0%} hit rate)")
+    for line in ccache("--show-stats").splitlines():
+        log(line, level=logging.DEBUG)
+
+
+@requires("install_base_packages", "install_development_virtualenv")
+@uses_apt(
+    "libx11-dev",
+    "libxpm-dev",
+    "libxft-dev",
+    "libxext-dev",
+    "libpng-dev",
+    "libjpeg-dev",
+    "ccache",
+    "dpkg-dev",
+)
 def install_root_from_source(virtualenv_name: str, n_threads: int, github_token: str):
     """
     Find latest ROOT sources, compile them, and link to the Python virtual environment
@@ -939,16 +2788,7 @@ def install_root_from_source(virtualenv_name: str, n_threads: int, github_token:
     """
     tag = find_latest_github_tag(github_token, "root-project", "root")
     log(f"Found latest root {tag.name}")
-
-    # Install deps
-    install_with_apt(
-        "libx11-dev",
-        "libxpm-dev",
-        "libxft-dev",
-        "libxext-dev",
-        "libpng-dev",
-        "libjpeg-dev",
-    )
+    record_installed_version("root", tag.name)
 
     # Find various paths for virtual environment
     sysconfig_data = get_pyenv_sysconfig_data(virtualenv_name)
@@ -964,10 +2804,20 @@ def install_root_from_source(virtualenv_name: str, n_threads: int, github_token:
         "PYTHON_EXECUTABLE": python_bin_path,
         "python": "ON",
         "minuit2": "ON",
+        **CCACHE_CMAKE_FLAGS,
     }
 
+    build_key = get_build_key(tag, cmake_flags, sysconfig_data)
+    if _install_built_packages(build_key):
+        source_in_zshrc(". /opt/root/bin/thisroot.sh")
+        return
+
     log(f"Installing root {tag}")
-    with local.cwd(make_or_find_libraries_dir()):
+    # Build in a directory of its own, as makey finds the extracted sources by comparing directory listings
+    build_path = make_or_find_libraries_dir() / "root"
+    build_path.mkdir(exist_ok=True)
+    build_started = time.time()
+    with compiler_cache() as ccache_env:
         cmd.makey[
             (
                 tag.tarball_url,
@@ -975,33 +2825,77 @@ def install_root_from_source(virtualenv_name: str, n_threads: int, github_token:
                 n_threads,
                 f"--version={tag.name.replace('v', '').replace('-', '.')}",
                 "--verbose",
+                "--build_only",
                 "--copt",
                 *cmake_options_from_dict(cmake_flags),
             )
-        ] & plumbum.FG
+        ].with_cwd(build_path).with_env(**ccache_env, **get_build_environment()) & plumbum.FG
+    deb_paths = find_built_packages(build_path, build_started)
+    _install_debs(deb_paths)
+    publish_built_packages(build_key, deb_paths, {"project": "root", "tag": tag.name})
 
-    # Insert this at start of zshrc to avoid adding /usr/local/bin to head of path
-    prepend_to_zshrc(". /opt/root/bin/thisroot.sh")
+    # Source this before PATH is set to avoid adding /usr/local/bin to head of path
+    source_in_zshrc(". /opt/root/bin/thisroot.sh")
 
 
+@requires("install_development_virtualenv", "install_conda_packages")
+# Declare the packages of the nested installer so that they are collected into the same transaction
+@uses_apt(*install_root_from_source.apt_packages)
+def install_root(virtualenv_name: str, use_conda: bool, n_threads: int, github_token: str):
+    """
+    Install ROOT from conda-forge if conda is available in the virtual environment, otherwise from source
+    :param virtualenv_name: name of PyEnv environment to install into
+    :param use_conda: whether to prefer the conda package
+    :param n_threads: number of threads to use for compiling
+    :param github_token: GitHub personal authentication token
+    :return:
+    """
+    try:
+        get_conda(virtualenv_name)
+    except FileNotFoundError:
+        use_conda = False
+
+    # The conda package is installed in the transaction of `install_conda_packages`
+    if not use_conda:
+        install_root_from_source(virtualenv_name, n_threads, github_token)
+
+
+@requires("install_base_packages", "install_pyenv", "install_zsh")
+@uses_apt(
+    "libxerces-c-dev",
+    "libxmu-dev",
+    "libexpat1-dev",
+    "freeglut3",
+    "freeglut3-dev",
+    "mesa-utils",
+    "ccache",
+    "dpkg-dev",
+)
 def install_geant4(github_token: str, n_threads: int):
     tag = find_latest_github_tag(github_token, "Geant4", "geant4")
+    record_installed_version("geant4", tag.name)
     cmake_flags = {
         "GEANT4_INSTALL_DATA": "ON",
         "GEANT4_USE_OPENGL_X11": "ON",
         "GEANT4_USE_GDML": "ON",
+        **CCACHE_CMAKE_FLAGS,
     }
-
-    install_with_apt(
-        "libxerces-c-dev",
-        "libxmu-dev",
-        "libexpat1-dev",
-        "freeglut3",
-        "freeglut3-dev",
-        "mesa-utils",
-    )
-
-    with local.cwd(make_or_find_libraries_dir()):
+    geant4_source = """
+cd $(dirname $(which geant4.sh))
+. geant4.sh
+cd - > /dev/null"""
+    # Exclude this path because it's a recursive symlink which causes issues
+    dpkg_flags = ("--path-exclude=/usr/local/lib/Geant4-*/Linux-g++/*",)
+
+    build_key = get_build_key(tag, cmake_flags, patch_url=GEANT4_CPACK_PATCH_URL)
+    if _install_built_packages(build_key, *dpkg_flags):
+        source_in_zshrc(geant4_source)
+        return
+
+    build_path = make_or_find_libraries_dir() / "geant4"
+    build_path.mkdir(exist_ok=True)
+    build_started = time.time()
+    with compiler_cache() as ccache_env:
         cmd.makey[
             (
                 tag.tarball_url,
@@ -1011,28 +2905,18 @@ def install_geant4(github_token: str, n_threads: int):
                 GEANT4_CPACK_PATCH_URL,
                 "--copt",
                 *cmake_options_from_dict(cmake_flags),
-                "--dflag",
-                # Exclude this path because it's a recursive symlink which causes issues
-                "path-exclude=/usr/local/lib/Geant4-*/Linux-g++/*",
                 "--verbose",
+                "--build_only",
             )
-        ] & plumbum.FG
-    prepend_to_zshrc(
-        """
-cd $(dirname $(which geant4.sh))
-. geant4.sh
-cd - > /dev/null"""
-    )
-
-
-def add_apt_repository(repo):
-    cmd.sudo[cmd.add_apt_repository[repo]]()
+        ].with_cwd(build_path).with_env(**ccache_env, **get_build_environment()) & plumbum.FG
+    deb_paths = find_built_packages(build_path, build_started)
+    _install_debs(deb_paths, *dpkg_flags)
+    publish_built_packages(build_key, deb_paths, {"project": "geant4", "tag": tag.name})
+    source_in_zshrc(geant4_source)
 
 
+@uses_apt('regolith-desktop', 'regolith-look-ayu-mirage', repositories=('ppa:regolith-linux/release',))
 def install_regolith():
-    add_apt_repository('ppa:regolith-linux/release')
-    install_with_apt('regolith-desktop', 'regolith-look-ayu-mirage')
-
     # Set theme
     cmd.regolith_look('set', 'ayu-mirage')
     cmd.regolith_look('refresh')
@@ -1047,37 +2931,319 @@ def install_meslo_nerdfont():
     fonts_dir = local.path('.fonts')
     fonts_dir.mkdir()
     
-    with local.cwd(fonts_dir):
-        for url in font_urls:
-            cmd.wget(url)
+    for url in font_urls:
+        download(url, fonts_dir)
     
 
+@uses_apt('alacritty', repositories=('ppa:mmstick76/alacritty',))
 def install_alacritty():
-    add_apt_repository('ppa:mmstick76/alacritty')
-    install_with_apt('alacritty')
     # Install terminfo - https://github.com/alacritty/alacritty/blob/master/INSTALL.md#terminfo
-    with local.cwd('/tmp'):
-        cmd.wget('https://raw.githubusercontent.com/alacritty/alacritty/master/extra/alacritty.info')
-        cmd.sudo['tic', '-xe', 'alacritty,alacritty-direct', 'alacritty.info']()
+    info_path = download('https://raw.githubusercontent.com/alacritty/alacritty/master/extra/alacritty.info')
+    cmd.sudo['tic', '-xe', 'alacritty,alacritty-direct', info_path]()
         
     config_dir = local.path('~/.config/alacritty')
     config_dir.mkdir()    
-    cmd.wget('https://gist.github.com/agoose77/69a87cae13d29a87237cd7e7b8f01d6c/raw', '-O', config_dir/'alacritty.yml')
+    download('https://gist.github.com/agoose77/69a87cae13d29a87237cd7e7b8f01d6c/raw', config_dir/'alacritty.yml')
 
     # Set default terminal
     cmd.sudo['update-alternatives', '--set', 'x-terminal-emulator', local.which('alacritty')]()
     
 
-def bootstrap():
-    """Install system pip, and subsequently plumbum"""
-    install_pip()
-    install_plumbum()
+# Benchmarks ###########################################################################################################
+# Parameter expansion stops the echoed command from matching the marker
+FIRST_PROMPT_MARKER = "__SETUP_FIRST_PROMPT__"
+FIRST_PROMPT_PROBE = "print ${:-__SETUP}_FIRST_PROMPT__"
+
+
+class TimingSummary(NamedTuple):
+    median: float
+    p95: float
+    n_runs: int
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarise_timings(timings: List[float]) -> TimingSummary:
+    return TimingSummary(
+        median=percentile(timings, 0.5), p95=percentile(timings, 0.95), n_runs=len(timings)
+    )
+
+
+@contextmanager
+def scratch_home(zshrc_path: Path, zinit_path: Path, copy_zinit: bool = False):
+    """Create a temporary HOME containing a copy of `zshrc_path`, and links to the p10k configuration and zinit.
+
+    :param zshrc_path: path to .zshrc under test
+    :param zinit_path: path to zinit home directory (may contain stub plugins)
+    :param copy_zinit: copy the zinit directory instead of linking it, so that it may be modified (e.g. compiled)
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        home_path = Path(directory)
+        shutil.copyfile(zshrc_path, home_path / ".zshrc")
+
+        p10k_path = HOME_PATH / ".p10k.zsh"
+        if p10k_path.exists():
+            shutil.copyfile(p10k_path, home_path / ".p10k.zsh")
+        if zinit_path.exists():
+            if copy_zinit:
+                shutil.copytree(zinit_path, home_path / ".zinit", symlinks=True)
+            else:
+                (home_path / ".zinit").symlink_to(zinit_path.resolve())
+        yield home_path
+
+
+def get_scratch_env(home_path: Path) -> Dict[str, str]:
+    env = {**os.environ, "HOME": str(home_path), "XDG_CACHE_HOME": str(home_path / ".cache")}
+    env.pop("ZDOTDIR", None)
+    return env
+
+
+def time_shell_startup(home_path: Path, n_runs: int) -> List[float]:
+    """Time `zsh -i -c exit` in a given HOME
+
+    :param home_path: HOME directory
+    :param n_runs: number of runs
+    :return: durations in seconds
+    """
+    env = get_scratch_env(home_path)
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        check_call(
+            ["zsh", "-i", "-c", "exit"], env=env, cwd=home_path, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_first_prompt(home_path: Path, n_runs: int, timeout: float = 30) -> List[float]:
+    """Time an interactive zsh until it executes its first command, i.e. until the first prompt is ready
+
+    :param home_path: HOME directory
+    :param n_runs: number of runs
+    :param timeout: maximum time to wait for the prompt
+    :return: durations in seconds
+    """
+    import pexpect
+
+    env = get_scratch_env(home_path)
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        child = pexpect.spawn("zsh", ["-i"], env=env, cwd=str(home_path), encoding="utf-8", timeout=timeout)
+        try:
+            # Input is buffered by the terminal until zsh reads its first command
+            child.sendline(FIRST_PROMPT_PROBE)
+            child.expect_exact(FIRST_PROMPT_MARKER)
+            timings.append(time.perf_counter() - start)
+        finally:
+            child.close(force=True)
+    return timings
+
+
+def benchmark_shell_startup(
+    zshrc_path: Path,
+    zinit_path: Path,
+    n_runs: int = 10,
+    n_warmup_runs: int = 1,
+    budget: float = None,
+    prompt_budget: float = None,
+    compare_zcompile: bool = False,
+) -> bool:
+    """Measure the startup latency of a zsh configuration in a scratch HOME.
+
+    :param zshrc_path: path to .zshrc under test
+    :param zinit_path: path to zinit home directory
+    :param n_runs: number of timed runs of each measurement
+    :param n_warmup_runs: number of untimed runs, which let zinit compile and cache
+    :param budget: maximum p95 of `zsh -i -c exit` in milliseconds
+    :param prompt_budget: maximum p95 time to first prompt in milliseconds
+    :param compare_zcompile: measure again after `precompile_zsh_startup`, applying the budgets to this measurement
+    :return: whether the budgets were met
+    """
+    results = []
+    # zcompile writes .zwc files alongside the plugin sources, which must not reach the real zinit directory
+    with scratch_home(zshrc_path, zinit_path, copy_zinit=compare_zcompile) as home_path:
+        variants = [("", not compare_zcompile)]
+        if compare_zcompile:
+            variants.append((" (zcompiled)", True))
+
+        for suffix, is_budgeted in variants:
+            if suffix:
+                precompile_zsh_startup(home_path)
+            time_shell_startup(home_path, n_warmup_runs)
+            results += [
+                (
+                    f"zsh -i -c exit{suffix}",
+                    summarise_timings(time_shell_startup(home_path, n_runs)),
+                    budget if is_budgeted else None,
+                ),
+                (
+                    f"first prompt{suffix}",
+                    summarise_timings(time_first_prompt(home_path, n_runs)),
+                    prompt_budget if is_budgeted else None,
+                ),
+            ]
+
+    within_budget = True
+    for name, summary, limit in results:
+        log(
+            f"{name}: median {summary.median * 1e3:.1f} ms, p95 {summary.p95 * 1e3:.1f} ms "
+            f"over {summary.n_runs} runs"
+        )
+        if limit is not None and summary.p95 * 1e3 > limit:
+            log(f"{name} exceeded budget of {limit:.1f} ms", logging.ERROR)
+            within_budget = False
+    return within_budget
+
+
+# Plugins whose measured load time (in seconds) reaches each threshold are deferred by a further wait level
+ZINIT_WAIT_THRESHOLDS = (0.005, 0.02)
+ZINIT_LOAD_PATTERN = re.compile(
+    r"^(?:zinit ice (?P<ices>.*)\n)?zinit (?P<loader>light|load|snippet) (?P<name>\S+)$", re.MULTILINE
+)
+ZINIT_WAIT_ICE_PATTERN = re.compile(r"""\s*(?:\$\{WAIT\}|wait(?:"[^"]*"|'[^']*')?)(?=\s|$)""")
+ZINIT_TIMES_PATTERN = re.compile(r"^\s*(?P<time>[\d.]+)\s*(?P<unit>ms|sec)\s*-\s*(?P<name>\S+)", re.MULTILINE)
+
+
+def load_zinit_profile() -> Dict[str, float]:
+    try:
+        return json.loads(ZINIT_PROFILE_PATH.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def get_zinit_wait_level(load_time: float) -> int:
+    return sum(load_time >= t for t in ZINIT_WAIT_THRESHOLDS)
+
+
+def strip_zinit_wait_ices(zshrc_contents: str) -> str:
+    """Remove wait ices so that every plugin loads synchronously"""
 
-    # Import modules
+    def replacer(match_obj):
+        ices = match_obj.group("ices")
+        if ices is None or not ZINIT_WAIT_ICE_PATTERN.search(ices):
+            return match_obj.group(0)
+        ices = ZINIT_WAIT_ICE_PATTERN.sub("", ices).strip()
+        ice_string = f"zinit ice {ices}\n" if ices else ""
+        return f"{ice_string}zinit {match_obj.group('loader')} {match_obj.group('name')}"
+
+    return ZINIT_LOAD_PATTERN.sub(replacer, zshrc_contents)
+
+
+def assign_zinit_wait_levels(zshrc_contents: str, load_times: Dict[str, float]) -> str:
+    """Replace the wait ices of deferred plugins with a wait level chosen from their load time.
+
+    Plugins without a wait ice are essential, and remain synchronous.
+
+    :param zshrc_contents: contents of .zshrc
+    :param load_times: mapping from plugin name to load time in seconds
+    :return:
+    """
+
+    def replacer(match_obj):
+        ices = match_obj.group("ices")
+        name = match_obj.group("name")
+        if ices is None or name not in load_times or not ZINIT_WAIT_ICE_PATTERN.search(ices):
+            return match_obj.group(0)
+
+        level = get_zinit_wait_level(load_times[name])
+        ices = f'wait"{level}" {ZINIT_WAIT_ICE_PATTERN.sub("", ices).strip()}'.strip()
+        return f"zinit ice {ices}\nzinit {match_obj.group('loader')} {name}"
+
+    return ZINIT_LOAD_PATTERN.sub(replacer, zshrc_contents)
+
+
+def parse_zinit_times(output: str) -> Dict[str, float]:
+    """Parse the output of `zinit times` into a mapping from plugin name to load time in seconds"""
+    output = re.sub(r"\x1b\[[0-9;]*m", "", output)
+    return {
+        m.group("name"): float(m.group("time")) / (1e3 if m.group("unit") == "ms" else 1)
+        for m in ZINIT_TIMES_PATTERN.finditer(output)
+    }
+
+
+def profile_zinit_plugins(zshrc_path: Path, zinit_path: Path, n_runs: int = 5, dry_run: bool = False) -> Dict[str, float]:
+    """Measure the load time of each zinit plugin and snippet, and assign wait levels accordingly.
+
+    Every plugin is loaded synchronously in a scratch HOME, and `zinit times` is averaged over several runs.
+    Expensive plugins are deferred to later wait levels, whilst essential (synchronous) plugins are left alone.
+    The measurements are saved for subsequent provisions.
+
+    :param zshrc_path: path to .zshrc
+    :param zinit_path: path to zinit home directory
+    :param n_runs: number of shells to average over
+    :param dry_run: report the measurements without rewriting .zshrc
+    :return: mapping from plugin name to mean load time in seconds
+    """
+    zshrc_contents = zshrc_path.read_text()
+
+    totals: Dict[str, float] = {}
+    with scratch_home(zshrc_path, zinit_path) as home_path:
+        (home_path / ".zshrc").write_text(strip_zinit_wait_ices(zshrc_contents))
+        for _ in range(n_runs):
+            output = check_output(
+                ["zsh", "-i", "-c", "zinit times -s"], env=get_scratch_env(home_path), cwd=home_path, stdin=DEVNULL,
+            )
+            for name, load_time in parse_zinit_times(output.decode()).items():
+                totals[name] = totals.get(name, 0.0) + load_time
+
+    load_times = {name: total / n_runs for name, total in totals.items()}
+    for name, load_time in sorted(load_times.items(), key=lambda item: -item[1]):
+        log(f"{load_time * 1e3:7.1f} ms  wait\"{get_zinit_wait_level(load_time)}\"  {name}")
+
+    if not dry_run:
+        ZINIT_PROFILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        ZINIT_PROFILE_PATH.write_text(json.dumps(load_times, indent=2))
+
+        fd, temp_path = tempfile.mkstemp(dir=zshrc_path.parent, prefix=f"{zshrc_path.name}.")
+        with open(fd, "w") as f:
+            f.write(assign_zinit_wait_levels(zshrc_contents, load_times))
+        os.replace(temp_path, zshrc_path)
+    return load_times
+
+
+# Shell startup ########################################################################################################
+ZCOMPILE_SOURCE = """
+setopt extended_glob null_glob
+for f in $HOME/.zshrc $HOME/.p10k.zsh ${ZDOTDIR:-$HOME}/.zcompdump $HOME/.zinit/{plugins,snippets}/**/*.zsh; do
+  [[ -f $f ]] && zcompile -- $f
+done
+"""
+
+
+def precompile_zsh_startup(home_path: Path = HOME_PATH):
+    """Compile the shell startup files to .zwc files, which zsh loads in place of the (older) sources.
+
+    This covers .zshrc, the p10k configuration, the completion dump and the zinit plugin sources.
+
+    :param home_path: HOME directory containing the configuration
+    :return:
+    """
+    env = get_scratch_env(home_path) if home_path != HOME_PATH else None
+    check_call(["zsh", "-f", "-c", ZCOMPILE_SOURCE], env=env, cwd=home_path, stdin=DEVNULL)
+
+
+def bootstrap():
+    """Import plumbum, first installing it (and system pip) only if it is missing"""
     global plumbum, cmd, local
-    import plumbum
+    try:
+        import plumbum
+    except ImportError:
+        import importlib.util
+
+        if importlib.util.find_spec("pip") is None:
+            install_pip()
+        install_plumbum()
+        import plumbum
+
     from plumbum import cmd, local
-    import plumbum.colors
 
 
 NO_DEFAULT = object()
@@ -1110,21 +3276,86 @@ def get_user_input(prompt: str, default=NO_DEFAULT, converter=None):
         return value
 
 
+# Rough peak resident memory of a single compiler job, in bytes, for each project built from source
+BUILD_MEMORY_PER_JOB = {
+    "root": 2.5 * 2 ** 30,
+    "geant4": 1.5 * 2 ** 30,
+    "python": 0.5 * 2 ** 30,
+}
+DEFAULT_BUILD_MEMORY_PER_JOB = 2 ** 30
+
+
+def read_cgroup_cpu_limit() -> float:
+    """Return the number of CPUs allowed by the cgroup CPU quota, or infinity if there is no quota."""
+    try:
+        # cgroup v2
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            quota = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text().strip()
+            period = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return math.inf
+
+    if quota in {"max", "-1"}:
+        return math.inf
+    return int(quota) / int(period)
+
+
+def read_available_memory() -> int:
+    """Return the memory available for new processes, in bytes, including any cgroup memory limit."""
+    meminfo = Path("/proc/meminfo").read_text()
+    available = int(re.search(r"^MemAvailable:\s+(\d+) kB", meminfo, re.MULTILINE).group(1)) * 1024
+
+    try:
+        limit = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+        current = Path("/sys/fs/cgroup/memory.current").read_text().strip()
+    except OSError:
+        return available
+
+    if limit == "max":
+        return available
+    return min(available, int(limit) - int(current))
+
+
 def get_max_system_threads() -> int:
-    """Return the number of threads available on the system."""
-    return int(check_output(["grep", "-c", "cores", "/proc/cpuinfo"]).decode().strip())
+    """Return the number of threads that this process may use, respecting CPU affinity and cgroup quotas."""
+    n_threads = len(os.sched_getaffinity(0))
+    cgroup_limit = read_cgroup_cpu_limit()
+    if cgroup_limit < n_threads:
+        n_threads = math.ceil(cgroup_limit)
+    return max(1, n_threads)
+
 
+def get_safe_build_threads(project: str = "root") -> int:
+    """Return the largest number of build jobs for `project` that fit in the available CPUs and memory.
 
-def convert_number_threads(n_total_threads: int, n_threads_str: str) -> int:
+    :param project: name of project in `BUILD_MEMORY_PER_JOB`
+    :return:
+    """
+    memory_per_job = BUILD_MEMORY_PER_JOB.get(project, DEFAULT_BUILD_MEMORY_PER_JOB)
+    n_memory_threads = int(read_available_memory() // memory_per_job)
+    return max(1, min(get_max_system_threads(), n_memory_threads))
+
+
+def convert_number_threads(n_total_threads: int, n_threads_str: str, n_safe_threads: int = None) -> int:
     """Validate and clamp requested number of threads string to those available.
 
     :param n_total_threads: number of total threads
     :param n_threads_str: string of requested number of threads
+    :param n_safe_threads: number of threads above which builds are likely to run out of memory
     :return:
     """
     n_threads = int(n_threads_str)
     if not 0 < n_threads <= n_total_threads:
         raise ValueError(f"Invalid number of threads {n_threads}!")
+    if n_safe_threads is not None and n_threads > n_safe_threads:
+        log(
+            f"{n_threads} build threads may exhaust the available memory and swap; "
+            f"at most {n_safe_threads} is recommended",
+            logging.WARNING,
+        )
     return n_threads
 
 
@@ -1179,10 +3410,11 @@ def deferred_user_input(prompt: str, default=NO_DEFAULT, converter=None):
 def create_user_config() -> Config:
     config = Config()
     config.N_MAX_SYSTEM_THREADS = get_max_system_threads()
+    config.N_SAFE_BUILD_THREADS = get_safe_build_threads()
     config.N_BUILD_THREADS = deferred_user_input(
         "Enter number of build threads",
-        config.N_MAX_SYSTEM_THREADS,
-        lambda s: convert_number_threads(config.N_MAX_SYSTEM_THREADS, s),
+        config.N_SAFE_BUILD_THREADS,
+        lambda s: convert_number_threads(config.N_MAX_SYSTEM_THREADS, s, config.N_SAFE_BUILD_THREADS),
     )
     config.DEVELOPMENT_VIRTUALENV_NAME = deferred_user_input(
         "Enter virtualenv name", "sci"
@@ -1202,101 +3434,709 @@ def create_user_config() -> Config:
     config.ROOT_USE_CONDA = deferred_user_input(
         "Use Conda package for ROOT?", "y", yes_no_to_bool
     )
+    return config
+
+
+@contextmanager
+def sudo_credentials():
+    """Cache sudo credentials, and keep them cached until the body exits.
+
+    Builds can outlast the sudo timeout, after which concurrent installers would all prompt for the password at once.
+    """
+    cmd.sudo["-v"] & plumbum.FG
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(SUDO_REFRESH_INTERVAL):
+            cmd.sudo["-n", "-v"] & plumbum.TF
 
-    # Install ROOT
-    @config.set
-    def CONDA_CMD():
-        # If conda is installed at all
+    thread = threading.Thread(target=refresh, name="sudo-refresh", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def install_all(
+    config: Config, n_jobs: int = 1, zcompile: bool = False, resume: bool = True, trace_path: Path = None
+):
+    """Install everything, running up to `n_jobs` independent installers concurrently.
+
+    Configuration values are resolved whilst building the list of steps, so that all prompts happen up-front.
+    Installers which finished in an earlier, unfinished run with the same arguments are skipped unless `resume` is
+    false. The run journal is cleared once every installer has succeeded.
+
+    :param config: user configuration
+    :param n_jobs: maximum number of concurrently running installers
+    :param zcompile: precompile the shell startup files after installation
+    :param resume: skip installers recorded in the run journal
+    :param trace_path: path to write a Chrome trace of the installation to
+    :return:
+    """
+    global JOURNAL, JOBSERVER, TIMINGS
+    JOURNAL = RunJournal(JOURNAL_PATH, resume)
+    steps = get_install_steps(config)
+    TIMINGS = TimingDatabase(TIMINGS_PATH)
+    TIMINGS.start_run(get_machine_info())
+    sampler = ResourceSampler(TIMINGS)
+
+    # Cache sudo credentials so that concurrent installers don't compete for the password prompt
+    with sudo_credentials(), synchronised_environment(), \
+            tracing(trace_path) if trace_path is not None else nullcontext():
+        preinstall_apt_packages(steps)
+        # Concurrent builds share one pool of N_BUILD_THREADS jobs
+        JOBSERVER = Jobserver(config.N_BUILD_THREADS)
+        sampler.start()
         try:
-            return get_conda(config.DEVELOPMENT_VIRTUALENV_NAME)
-        except FileNotFoundError:
-            return None
+            run_steps(steps, n_jobs)
+        finally:
+            sampler.stop()
+            JOBSERVER.close()
+            JOBSERVER = None
+            TIMINGS.close()
+            TIMINGS = None
+            # Write the configuration of whichever installers finished
+            ZSHRC.write()
 
-    return config
+    # Only an unfinished provision is resumed, so that later provisions pick up new releases
+    JOURNAL.clear()
+
+    if zcompile:
+        precompile_zsh_startup()
+
+
+def get_install_steps(config: Config) -> List[Step]:
+    """Return the steps of a full installation, resolving (and prompting for) the configuration values they use.
+
+    :param config: user configuration
+    :return:
+    """
+    return [
+        Step(install_base_packages),
+        Step(install_git, (config.GIT_USER_NAME, config.GIT_EMAIL_ADDRESS)),
+        Step(install_zsh),
+        Step(install_meslo_nerdfont),
+        Step(install_regolith),
+        Step(install_alacritty),
+        Step(install_zinit),
+        Step(install_git_shortcuts),
+        Step(install_git_flow),
+        Step(install_with_apt, ("git-lfs",)),
+        Step(install_chrome),
+        Step(
+            install_gnupg,
+            (config.GIT_USER_NAME, config.GIT_EMAIL_ADDRESS, config.GIT_KEY_LENGTH),
+        ),
+        Step(install_fd),
+        Step(install_tmux),
+        Step(install_pyenv, (config.SYSTEM_VENV_NAME,)),
+        Step(
+            install_development_virtualenv,
+            (config.DEVELOPMENT_PYTHON_VERSION, config.DEVELOPMENT_VIRTUALENV_NAME, config.N_BUILD_THREADS),
+        ),
+        Step(
+            install_conda_packages,
+            (config.DEVELOPMENT_VIRTUALENV_NAME, *get_conda_requests(config.ROOT_USE_CONDA)),
+        ),
+        *(
+            Step(install_with_snap, (package,), {"classic": True})
+            for package in (
+                    "pycharm-professional",
+                    "clion",
+                    "webstorm",
+            )
+        ),
+        Step(install_with_snap, ("thunderbird",), {"beta": True}),
+        Step(install_with_snap, ("spotify",)),
+        Step(install_with_snap, ("mathpix-snipping-tool",)),
+        Step(install_micro),
+        Step(install_with_snap, ("atom",), {"classic": True}),
+        Step(install_with_apt, ("polari",)),
+        Step(install_with_apt, ("vlc",)),
+        Step(install_with_apt, ("fzf",)),
+        Step(install_with_snap, ("gimp",)),
+        Step(install_with_apt, ("ripgrep",)),
+        #Step(install_powerline_fonts),
+
+        #Step(install_gnome_favourites),
+        Step(install_gnome_theme),
+        Step(install_gnome_tweak_tool),
+        #Step(install_canta_theme),
+        Step(install_pandoc, (config.GITHUB_TOKEN,)),
+        Step(
+            install_root,
+            (
+                config.DEVELOPMENT_VIRTUALENV_NAME,
+                config.ROOT_USE_CONDA,
+                config.N_BUILD_THREADS,
+                config.GITHUB_TOKEN,
+            ),
+        ),
+        Step(install_geant4, (config.GITHUB_TOKEN, config.N_BUILD_THREADS)),
+        Step(install_jupyterlab_build, (config.DEVELOPMENT_VIRTUALENV_NAME,)),
+        Step(install_tex),
+        Step(
+            install_precompiled_bytecode,
+            (config.SYSTEM_VENV_NAME, config.DEVELOPMENT_VIRTUALENV_NAME),
+        ),
+    ]
+
+
+# Planning #############################################################################################################
+class RecordedCommand:
+    """Stand-in for a plumbum command, which records invocations instead of running them"""
+
+    def __init__(self, backend: "RecordingBackend", argvs: Tuple[Tuple[str, ...], ...], env=None, cwd=None):
+        self.backend = backend
+        self.argvs = argvs
+        self.env = env or {}
+        self.cwd = cwd
+
+    def _replace(self, **kwargs) -> "RecordedCommand":
+        fields = {"argvs": self.argvs, "env": self.env, "cwd": self.cwd, **kwargs}
+        return RecordedCommand(self.backend, **fields)
+
+    def __getitem__(self, args) -> "RecordedCommand":
+        if not isinstance(args, tuple):
+            args = (args,)
+        flattened = []
+        for arg in args:
+            if isinstance(arg, RecordedCommand):
+                flattened.extend(arg.argvs[-1])
+            else:
+                flattened.append(str(arg))
+        return self._replace(argvs=(*self.argvs[:-1], (*self.argvs[-1], *flattened)))
+
+    def __or__(self, other: "RecordedCommand") -> "RecordedCommand":
+        return self._replace(argvs=(*self.argvs, *other.argvs))
+
+    def __lshift__(self, data) -> "RecordedCommand":
+        return self
+
+    def __gt__(self, path) -> "RecordedCommand":
+        return self._replace(argvs=(*self.argvs[:-1], (*self.argvs[-1], ">", str(path))))
+
+    def with_env(self, **env) -> "RecordedCommand":
+        return self._replace(env={**self.env, **env})
+
+    def with_cwd(self, cwd) -> "RecordedCommand":
+        return self._replace(cwd=cwd)
+
+    def __str__(self):
+        command = " | ".join(" ".join(shlex.quote(a) for a in argv) for argv in self.argvs)
+        env = "".join(f"{k}={shlex.quote(str(v))} " for k, v in self.env.items())
+        cwd = f" (in {self.cwd})" if self.cwd is not None else ""
+        return f"{env}{command}{cwd}"
+
+    def __call__(self, *args, **kwargs) -> str:
+        self[args].backend.record("run", str(self[args]))
+        return ""
+
+    def run(self, args=(), **kwargs) -> Tuple[int, str, str]:
+        self(*args)
+        return 0, "", ""
+
+    def popen(self, args=(), **kwargs):
+        self(*args)
+        return iter(())
 
+    def __and__(self, modifier):
+        self()
+        # Assume that tested commands succeed
+        if modifier is plumbum.TF:
+            return True
+        return None
 
-def install_all(config: Config):
-    install_with_apt(
-        "cmake",
-        'curl',
-        'wget',
-        "cmake-gui",
-        "build-essential",
-        "aria2",
-        "openssh-server",
-        "checkinstall",
-        "htop",
-        "lm-sensors",
-        "flameshot",
-        "libreadline-dev",
-        "libffi-dev",
-        "libsqlite3-dev",
-        "xclip",
-        "libbz2-dev",
+
+class RecordingCommandFactory:
+    """Stand-in for `plumbum.cmd`"""
+
+    def __init__(self, backend: "RecordingBackend"):
+        self._backend = backend
+
+    def __getattr__(self, name: str) -> RecordedCommand:
+        return RecordedCommand(self._backend, ((name.replace("_", "-"),),))
+
+
+class RecordingMachine:
+    """Stand-in for `plumbum.local`, which records commands but delegates paths and the environment"""
+
+    def __init__(self, backend: "RecordingBackend", machine):
+        self._backend = backend
+        self._machine = machine
+
+    def __getitem__(self, program) -> RecordedCommand:
+        return RecordedCommand(self._backend, ((str(program),),))
+
+    def which(self, program: str):
+        # Programs may only be installed by the recorded commands
+        try:
+            return self._machine.which(program)
+        except plumbum.CommandNotFound:
+            return self._machine.path("/usr/bin") / program
+
+    def __getattr__(self, name: str):
+        return getattr(self._machine, name)
+
+
+class RecordingBackend:
+    """Record of the commands, downloads and file edits that installers would make"""
+
+    def __init__(self):
+        self.actions: List[Tuple[str, str]] = []
+
+    def record(self, kind: str, description: str):
+        self.actions.append((kind, description))
+        log(f"{kind:>8} {description}")
+
+    def check_output(self, args, **kwargs) -> bytes:
+        self.record("run", " ".join(shlex.quote(str(a)) for a in args))
+        return b""
+
+    def check_call(self, args, **kwargs) -> int:
+        self.record("run", " ".join(shlex.quote(str(a)) for a in args))
+        return 0
+
+    def download(self, url: str, destination=None) -> Path:
+        self.record("download", url)
+        from urllib.parse import urlparse, unquote
+
+        return DOWNLOAD_CACHE_PATH / "planned" / unquote(Path(urlparse(url).path).name)
+
+    def create_gpg_key(self, name: str, email_address: str, key_length: int) -> Tuple[str, str]:
+        # python-gnupg runs gpg itself, rather than through plumbum, so key generation must be replaced as a whole
+        self.record("run", f"gpg --gen-key (RSA {key_length}, {name} <{email_address}>) in {GPG_HOME_PATH}")
+        return "", "<signing key>"
+
+
+def is_internal_path(path, ancestors: bool = False) -> bool:
+    """Return True if the path belongs to the caches or state of setup.py itself
+
+    :param path: path to test
+    :param ancestors: also return True for the directories which contain the caches or state
+    :return:
+    """
+    path = Path(path).absolute()
+    return any(
+        p == path or p in path.parents or (ancestors and path in p.parents) for p in (CACHE_PATH, STATE_PATH)
     )
-    install_git(config.GIT_USER_NAME, config.GIT_EMAIL_ADDRESS)
-    install_zsh()
 
-    install_meslo_nerdfont()
-    install_regolith()
-    install_alacritty()
-    
-    install_zinit()
-    install_git_shortcuts()
-    install_git_flow()
-    install_with_apt("git-lfs")
-    install_chrome()
-    install_gnupg(
-        config.GIT_USER_NAME, config.GIT_EMAIL_ADDRESS, config.GIT_KEY_LENGTH,
+
+@contextmanager
+def recording_backend():
+    """Replace the command, download and file-editing functions with ones that only record what would be done.
+
+    Writes to the caches of setup.py itself (such as GitHub responses) are still made.
+    """
+    from plumbum.path.local import LocalPath
+
+    backend = RecordingBackend()
+    replaced_globals = {
+        "cmd": RecordingCommandFactory(backend),
+        "local": RecordingMachine(backend, local),
+        "check_output": backend.check_output,
+        "check_call": backend.check_call,
+        "download": backend.download,
+        "create_gpg_key": backend.create_gpg_key,
+        # The environment only changes when the recorded commands run
+        "refresh_environment": lambda: {},
+    }
+    original_globals = {k: globals()[k] for k in replaced_globals}
+
+    def recording_method(method, describe):
+        @wraps(method)
+        def wrapper(path, *args, **kwargs):
+            # plumbum's link, copy and move write to their destination rather than to the path itself
+            written_path = args[0] if method.__name__ in {"symlink", "link", "copy", "move"} else path
+            # Creating an internal directory also creates its missing parents
+            if is_internal_path(written_path, ancestors=method.__name__ == "mkdir"):
+                return method(path, *args, **kwargs)
+            backend.record("write", describe(path, *args))
+        return wrapper
+
+    # File-system writes of both pathlib and plumbum paths
+    replaced_methods = {
+        (Path, "write_text"): lambda p, *a: str(p),
+        (Path, "touch"): lambda p, *a: str(p),
+        (Path, "mkdir"): lambda p, *a: f"{p}/",
+        (Path, "symlink_to"): lambda p, target, *a: f"{p} (symlink to {target})",
+        (LocalPath, "write"): lambda p, *a: str(p),
+        (LocalPath, "touch"): lambda p, *a: str(p),
+        (LocalPath, "mkdir"): lambda p, *a: f"{p}/",
+        (LocalPath, "symlink"): lambda p, dst, *a: f"{dst} (symlink to {p})",
+        (LocalPath, "link"): lambda p, dst, *a: f"{dst} (link to {p})",
+        (LocalPath, "copy"): lambda p, dst, *a: f"{dst} (copy of {p})",
+        (LocalPath, "move"): lambda p, dst, *a: f"{dst} (moved from {p})",
+        (LocalPath, "delete"): lambda p, *a: f"{p} (delete)",
+        (LocalPath, "chmod"): lambda p, mode, *a: f"{p} (mode {mode:o})",
+    }
+    original_methods = {(cls, name): getattr(cls, name) for cls, name in replaced_methods}
+    original_replace = os.replace
+
+    @wraps(original_replace)
+    def recording_replace(src, dst, *args, **kwargs):
+        # A missing source would have been produced by a recorded command, such as an archive written by tar
+        if os.path.lexists(src):
+            return original_replace(src, dst, *args, **kwargs)
+        backend.record("move", f"{src} -> {dst}")
+
+    globals().update(replaced_globals)
+    for (cls, name), describe in replaced_methods.items():
+        setattr(cls, name, recording_method(original_methods[cls, name], describe))
+    os.replace = recording_replace
+    try:
+        yield backend
+    finally:
+        globals().update(original_globals)
+        for (cls, name), method in original_methods.items():
+            setattr(cls, name, method)
+        os.replace = original_replace
+
+
+def format_duration(seconds: float) -> str:
+    if seconds >= 3600:
+        return f"{seconds // 3600:.0f}h{seconds % 3600 // 60:02.0f}m"
+    if seconds >= 60:
+        return f"{seconds // 60:.0f}m{seconds % 60:02.0f}s"
+    return f"{seconds:.0f}s"
+
+
+def estimate_step_duration(
+    step: Step, journal: RunJournal, durations: Dict[str, List[Tuple[float, float, str]]]
+) -> float:
+    """Estimate the duration of a step from the timing history, or return None if it has never finished before.
+
+    :param step: installation step
+    :param journal: run journal, whose entries are skipped
+    :param durations: durations of successful installers, from `TimingDatabase.get_durations`
+    :return: estimated duration in seconds
+    """
+    fingerprint = get_installer_fingerprint(step.func.__wrapped__, step.args, step.kwargs)
+    if journal.get(fingerprint) is not None:
+        return 0.0
+    call_string = format_installer_call(step.func.__wrapped__, step.args, step.kwargs)
+    if call_string in durations:
+        return durations[call_string][-1][1]
+
+    # Otherwise use the latest run of the same installer, with different arguments
+    runs = [run for name, runs in durations.items() if name.startswith(f"{step.func.__name__}(") for run in runs]
+    if not runs:
+        return None
+    return max(runs)[1]
+
+
+def plan_install(config: Config, resume: bool = True) -> RecordingBackend:
+    """List the commands, downloads and file edits of a full installation without making them, with time estimates.
+
+    Installers run against the recording backend, whose commands produce no output. An installer that depends on the
+    output of a command therefore cannot be planned beyond that point; this is reported and planning continues with
+    the next step.
+
+    :param config: user configuration
+    :param resume: assume that installers recorded in the run journal are skipped
+    :return: recording backend holding the planned actions
+    """
+    global JOURNAL
+
+    steps = get_install_steps(config)
+    journal = RunJournal(JOURNAL_PATH, resume, read_only=True)
+    database = TimingDatabase(TIMINGS_PATH)
+    try:
+        durations = database.get_durations(get_machine_fingerprint(get_machine_info()))
+    finally:
+        database.close()
+    estimates = [estimate_step_duration(step, journal, durations) for step in steps]
+
+    original_journal = JOURNAL
+    JOURNAL = journal
+    try:
+        with recording_backend() as backend:
+            preinstall_apt_packages(steps)
+            for step, estimate in zip(steps, estimates):
+                estimate_string = "unknown" if estimate is None else format_duration(estimate)
+                log(f"Estimated duration of {step.func.__name__}: {estimate_string}")
+                with ZSHRC.recording() as zshrc_changes:
+                    try:
+                        step.func(*step.args, **step.kwargs)
+                    except Exception as err:
+                        backend.record(
+                            "unknown", f"cannot plan the remaining actions ({type(err).__name__}: {err})"
+                        )
+                for kind, *arguments in zshrc_changes:
+                    summary = " ".join(a.strip().splitlines()[0] for a in arguments if a.strip())
+                    backend.record("edit", f"{ZSHRC_PATH} {kind} {summary:.80}")
+    finally:
+        JOURNAL = original_journal
+
+    known = [e for e in estimates if e is not None]
+    log(
+        f"Estimated total (serial) duration: {format_duration(sum(known))}, "
+        f"with {len(estimates) - len(known)} installer(s) never run before"
     )
-    install_fd()
-    install_tmux()
+    return backend
+
+
+# Orchestration benchmarks #############################################################################################
+@contextmanager
+def scratch_setup_state():
+    """Point HOME, and the paths and .zshrc document derived from it, at a temporary directory"""
+    with tempfile.TemporaryDirectory() as directory:
+        home_path = Path(directory)
+        cache_path = home_path / ".cache" / "setup"
+        state_path = home_path / ".local" / "state" / "setup"
+        replaced_globals = {
+            "HOME_PATH": home_path,
+            "ZSHRC_PATH": home_path / ".zshrc",
+            "ZPROFILE_PATH": home_path / ".zprofile",
+            "ZSHENV_PATH": home_path / ".zshenv",
+            "GPG_HOME_PATH": home_path / ".gnupg",
+            "CACHE_PATH": cache_path,
+            "DOWNLOAD_CACHE_PATH": cache_path / "downloads",
+            "ZINIT_PROFILE_PATH": cache_path / "zinit-profile.json",
+            "CCACHE_PATH": cache_path / "ccache",
+            "WHEELHOUSE_PATH": cache_path / "wheelhouse",
+            "JUPYTERLAB_BUILD_CACHE_PATH": cache_path / "jupyterlab-builds",
+            "CONDA_LOCKFILE_CACHE_PATH": cache_path / "conda-lockfiles",
+            "PYTHON_BUILD_CACHE_PATH": cache_path / "python-builds",
+            "BUILT_PACKAGES_PATH": cache_path / "apt-repository",
+            "GITHUB_CACHE_PATH": cache_path / "github",
+            "STATE_PATH": state_path,
+            "JOURNAL_PATH": state_path / "journal.jsonl",
+            "TIMINGS_PATH": state_path / "timings.sqlite",
+            "ZSHRC": ZshrcDocument(),
+        }
+        replaced_environ = {"HOME": directory, "USER": os.environ.get("USER", "setup")}
+
+        original_globals = {k: globals()[k] for k in replaced_globals}
+        original_environ = {k: os.environ.get(k) for k in replaced_environ}
+        globals().update(replaced_globals)
+        os.environ.update(replaced_environ)
+        try:
+            yield home_path
+        finally:
+            globals().update(original_globals)
+            for name, value in original_environ.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+
+def execute_canned_github_graphql_query(token: str, query: str) -> dict:
+    """Stand-in for `execute_github_graphql_query`, which answers every lookup without making requests"""
+    repository = {
+        "refs": {"edges": [{"node": {"name": "v1-0-0", "target": {"tarballUrl": "https://example.com/v1-0-0"}}}]},
+        "releases": {
+            "nodes": [
+                {
+                    "name": "1.0.0",
+                    "releaseAssets": {
+                        "nodes": [
+                            {
+                                "name": "package-1.0.0-amd64.deb",
+                                "contentType": "application/x-debian-package",
+                                "downloadUrl": "https://example.com/package-1.0.0-amd64.deb",
+                            }
+                        ]
+                    },
+                }
+            ]
+        },
+    }
+    return {"data": {"repository": repository, **{alias: repository for alias in GITHUB_PREFETCH_QUERIES}}}
+
 
-    install_pyenv(config.SYSTEM_VENV_NAME)
-    install_development_virtualenv(
-        config.DEVELOPMENT_PYTHON_VERSION, config.DEVELOPMENT_VIRTUALENV_NAME,
+@contextmanager
+def replaced_globals(**values):
+    """Temporarily replace module globals, which may shadow builtins such as `input`"""
+    missing = object()
+    original = {k: globals().get(k, missing) for k in values}
+    globals().update(values)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            if value is missing:
+                del globals()[name]
+            else:
+                globals()[name] = value
+
+
+def tolerate_failure(step: Step, failures: List[str]) -> Step:
+    """Wrap the installer of a step so that its failure is recorded instead of raised"""
+
+    @wraps(step.func)
+    def wrapper(*args, **kwargs):
+        try:
+            return step.func(*args, **kwargs)
+        except Exception as err:
+            failures.append(f"{step.func.__name__}: {type(err).__name__}: {err}")
+
+    return step._replace(func=wrapper)
+
+
+def benchmark_orchestration(n_runs: int = 5, n_jobs: int = 1, n_profile_functions: int = 10):
+    """Measure the time that setup.py itself spends around external commands.
+
+    `create_user_config`, `install_all` and the .zshrc helpers run against the recording backend (so no commands,
+    downloads or file edits are made) in a temporary HOME, with canned GitHub responses. Installers which parse
+    command output stop early, but the orchestration around them still runs. Environment reloads are measured with
+    the real zsh, if it is installed.
+
+    :param n_runs: number of timed runs of each scenario
+    :param n_jobs: number of concurrently running installers in `install_all`
+    :param n_profile_functions: number of functions to show in the profile of `install_all`
+    :return:
+    """
+    import cProfile
+    import pstats
+
+    answers = {"Enter GitHub personal token": "token"}
+    failures = []
+
+    def user_input(prompt: str) -> str:
+        return next((v for k, v in answers.items() if prompt.startswith(k)), "")
+
+    def run_create_user_config():
+        with scratch_setup_state():
+            config = create_user_config()
+            for name in list(vars(config)):
+                getattr(config, name)
+        return config
+
+    def run_install_all():
+        failures.clear()
+        tolerant_steps = lambda c: [tolerate_failure(s, failures) for s in original_get_install_steps(c)]
+        with scratch_setup_state(), recording_backend() as backend, replaced_globals(get_install_steps=tolerant_steps):
+            install_all(config, n_jobs, resume=False)
+        return backend
+
+    def run_zshrc_helpers():
+        with scratch_setup_state(), context():
+            for i in range(50):
+                update_path(f"$HOME/.local/opt/tool-{i}/bin")
+                append_to_zshrc(f"export TOOL_{i}_HOME=$HOME/.local/opt/tool-{i}")
+                source_in_zshrc(f"[ -f $HOME/.tool-{i}.zsh ] && . $HOME/.tool-{i}.zsh")
+            ZSHRC.write()
+
+    def run_refresh_environment():
+        with scratch_setup_state():
+            source_in_zshrc("export SETUP_BENCHMARK=1")
+
+    def run_log():
+        for i in range(1000):
+            log(f"Benchmark message {i}", logging.DEBUG)
+
+    original_get_install_steps = get_install_steps
+    original_stream = ch.setStream(io.StringIO())
+    try:
+        # Every scenario also runs in its own temporary HOME; this one catches anything that escapes them
+        with scratch_setup_state(), replaced_globals(
+            execute_github_graphql_query=execute_canned_github_graphql_query,
+            input=user_input,
+        ):
+            config = run_create_user_config()
+            scenarios = [
+                ("create_user_config", run_create_user_config),
+                ("install_all", run_install_all),
+                (".zshrc helpers (150 edits)", run_zshrc_helpers),
+                ("log (1000 messages)", run_log),
+            ]
+            if shutil.which("zsh"):
+                scenarios.append(("environment reload", run_refresh_environment))
+
+            results = []
+            for name, func in scenarios:
+                timings = []
+                for _ in range(n_runs):
+                    start = time.perf_counter()
+                    func()
+                    timings.append(time.perf_counter() - start)
+                results.append((name, summarise_timings(timings)))
+
+            # Installers normally run on worker threads, which the profiler does not see
+            def run_steps_serially(steps: List[Step], n_jobs: int = 1):
+                for step in steps:
+                    step.func(*step.args, **step.kwargs)
+
+            profile = cProfile.Profile()
+            with replaced_globals(run_steps=run_steps_serially):
+                backend = profile.runcall(run_install_all)
+    finally:
+        ch.setStream(original_stream)
+
+    for name, summary in results:
+        log(f"{name}: median {summary.median * 1e3:.1f} ms, p95 {summary.p95 * 1e3:.1f} ms over {summary.n_runs} runs")
+
+    install_all_summary = dict(results)["install_all"]
+    n_commands = sum(kind == "run" for kind, _ in backend.actions)
+    log(
+        f"install_all recorded {len(backend.actions)} actions ({n_commands} commands), "
+        f"{install_all_summary.median / max(len(backend.actions), 1) * 1e3:.2f} ms of overhead per action"
     )
-    for package in (
-            "pycharm-professional",
-            "clion",
-            "webstorm",
-    ):
-        install_with_snap(package, classic=True)
-
-    install_with_snap("thunderbird", beta=True)
-    install_with_snap("spotify")
-    install_with_snap("mathpix-snipping-tool")
-    install_micro()
-    install_with_snap("atom", classic=True)
-    install_with_apt("polari")
-    install_with_apt("vlc")
-    install_with_apt("fzf")
-    install_with_snap("gimp")
-    install_with_apt("ripgrep")
-    #install_powerline_fonts()
-
-    #install_gnome_favourites()
-    install_gnome_theme()
-    install_gnome_tweak_tool()
-    #install_canta_theme()
-    install_pandoc(config.GITHUB_TOKEN)
-
-    if config.CONDA_CMD and config.ROOT_USE_CONDA:
-        config.CONDA_CMD("install", "-c", "conda-forge", "root")
-    else:
-        install_root_from_source(
-            config.DEVELOPMENT_VIRTUALENV_NAME,
-            config.N_BUILD_THREADS,
-            config.GITHUB_TOKEN,
-        )
+    if failures:
+        log(f"{len(failures)} installer(s) stopped early on recorded command output:")
+        with context():
+            for failure in failures:
+                log(failure)
 
-    install_geant4(config.GITHUB_TOKEN, config.N_BUILD_THREADS)
-    install_tex()
-    
+    log("Functions with the most own time in install_all:")
+    stats = pstats.Stats(profile)
+    ranked = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+    with context():
+        for (filename, line, function), (_, n_calls, own_time, _, _) in ranked[:n_profile_functions]:
+            log(f"{own_time * 1e3:8.1f} ms {n_calls:7d} calls  {function} ({Path(filename).name}:{line})")
+
+
+# Import time ##########################################################################################################
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\S+)$", re.MULTILINE)
+
+
+def check_import_time(n_runs: int = 5, budget: float = 150.0, n_modules: int = 5) -> bool:
+    """Time loading this script (without running its command line) in fresh interpreters, against a budget.
 
+    The script has no test suite, so the budget is checked by running `setup.py import-time`, whose exit status is
+    non-zero if the budget is exceeded. The slowest top-level imports are reported as well.
+
+    :param n_runs: number of interpreters to time
+    :param budget: maximum median load time in ms
+    :param n_modules: number of top-level modules to report
+    :return: whether the budget was met
+    """
+    script = (
+        "import pkgutil, runpy, time; start = time.perf_counter(); "
+        f"runpy.run_path({str(Path(__file__).absolute())!r}, run_name='setup'); "
+        "print(time.perf_counter() - start)"
+    )
+    timings = [float(check_output([sys.executable, "-c", script])) for _ in range(n_runs)]
+    summary = summarise_timings(timings)
+    log(f"Script load: median {summary.median * 1e3:.1f} ms, p95 {summary.p95 * 1e3:.1f} ms over {summary.n_runs} runs")
+
+    # Top-level modules are those without indentation. Ignore those imported by the interpreter and harness
+    def get_import_times(source: str) -> List[Tuple[str, str]]:
+        output = check_output([sys.executable, "-X", "importtime", "-c", source], stderr=STDOUT).decode()
+        return IMPORT_TIME_PATTERN.findall(output)
+
+    baseline = {name for _, name in get_import_times("import pkgutil, runpy, time")}
+    slowest = sorted(
+        ((int(t), name) for t, name in get_import_times(script) if name not in baseline), reverse=True
+    )[:n_modules]
+    with context():
+        for cumulative_us, name in slowest:
+            log(f"{cumulative_us / 1e3:6.1f} ms  import {name}")
+
+    if summary.median * 1e3 > budget:
+        log(f"Script load exceeded budget of {budget:.1f} ms", logging.ERROR)
+        return False
+    return True
+
+
+# `install_all` runs the installers rather than being one, so it is neither journaled nor skipped
 INSTALLER_NAMES = [name
     for name, value in globals().items() 
-    if name.startswith("install_") and callable(value)
+    if name.startswith("install_") and name != "install_all" and callable(value)
 ]
 
     
@@ -1311,12 +4151,100 @@ if __name__ == "__main__":
     subparsers = parser.add_subparsers()
     
     install_parser = subparsers.add_parser('install')
+    install_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help="number of installers to run concurrently"
+    )
+    install_parser.add_argument(
+        '--zcompile', action='store_true', help="precompile shell startup files after installation"
+    )
+    install_parser.add_argument(
+        '--no-resume', dest='resume', action='store_false', help="rerun installers which finished previously"
+    )
+    install_parser.add_argument('--trace', type=Path, help="write a Chrome trace of the installation to this path")
     install_parser.set_defaults(install_all=True)
 
+    benchmark_parser = subparsers.add_parser('benchmark', help="measure zsh startup latency")
+    benchmark_parser.add_argument('-n', '--runs', type=int, default=10, help="number of timed runs")
+    benchmark_parser.add_argument('--warmup-runs', type=int, default=1, help="number of untimed runs")
+    benchmark_parser.add_argument('--budget', type=float, help="maximum p95 startup time in ms")
+    benchmark_parser.add_argument('--prompt-budget', type=float, help="maximum p95 time to first prompt in ms")
+    benchmark_parser.add_argument('--zshrc', type=Path, default=ZSHRC_PATH, help="path to .zshrc")
+    benchmark_parser.add_argument(
+        '--zinit-home', type=Path, default=HOME_PATH / ".zinit", help="path to zinit home (plugins)"
+    )
+    benchmark_parser.add_argument(
+        '--compare-zcompile', action='store_true', help="measure again with precompiled startup files"
+    )
+    benchmark_parser.set_defaults(benchmark_shell=True)
+
+    profile_parser = subparsers.add_parser('profile-plugins', help="assign zinit wait levels from load times")
+    profile_parser.add_argument('-n', '--runs', type=int, default=5, help="number of shells to average over")
+    profile_parser.add_argument('--dry-run', action='store_true', help="don't rewrite .zshrc")
+    profile_parser.add_argument('--zshrc', type=Path, default=ZSHRC_PATH, help="path to .zshrc")
+    profile_parser.add_argument(
+        '--zinit-home', type=Path, default=HOME_PATH / ".zinit", help="path to zinit home (plugins)"
+    )
+    profile_parser.set_defaults(profile_plugins=True)
+
+    report_parser = subparsers.add_parser('report', help="show installer timing trends and regressions")
+    report_parser.add_argument(
+        '--threshold', type=float, default=20.0, help="percentage slow-down relative to the median to flag"
+    )
+    report_parser.add_argument('--window', type=int, default=5, help="number of previous runs in the median")
+    report_parser.add_argument('--all-machines', action='store_true', help="include runs on other machines")
+    report_parser.set_defaults(report_timings=True)
+
+    orchestration_parser = subparsers.add_parser(
+        'benchmark-orchestration', help="measure the overhead of setup.py itself with recorded commands"
+    )
+    orchestration_parser.add_argument('-n', '--runs', type=int, default=5, help="number of timed runs")
+    orchestration_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help="number of installers to run concurrently"
+    )
+    orchestration_parser.set_defaults(benchmark_orchestration=True)
+
+    import_time_parser = subparsers.add_parser('import-time', help="check the startup time of setup.py")
+    import_time_parser.add_argument('-n', '--runs', type=int, default=5, help="number of timed runs")
+    import_time_parser.add_argument('--budget', type=float, default=150.0, help="maximum median load time in ms")
+    import_time_parser.set_defaults(check_import_time=True)
+
+    plan_parser = subparsers.add_parser('plan', help="list what install would do, with estimated timings")
+    plan_parser.add_argument(
+        '--no-resume', dest='resume', action='store_false', help="assume that no installers finished previously"
+    )
+    plan_parser.set_defaults(plan_install=True)
+
     args = parser.parse_args()
-    
+
+    # Benchmarks don't need plumbum, so can run offline
+    if hasattr(args, 'benchmark_shell'):
+        sys.exit(
+            not benchmark_shell_startup(
+                args.zshrc,
+                args.zinit_home,
+                args.runs,
+                args.warmup_runs,
+                args.budget,
+                args.prompt_budget,
+                args.compare_zcompile,
+            )
+        )
+    if hasattr(args, 'profile_plugins'):
+        profile_zinit_plugins(args.zshrc, args.zinit_home, args.runs, args.dry_run)
+        sys.exit()
+    if hasattr(args, 'check_import_time'):
+        sys.exit(not check_import_time(args.runs, args.budget))
+    if hasattr(args, 'report_timings'):
+        sys.exit(not report_installer_timings(args.threshold, args.window, args.all_machines))
+
     bootstrap()
+    if hasattr(args, 'benchmark_orchestration'):
+        benchmark_orchestration(args.runs, args.jobs)
+        sys.exit()
+
     config = create_user_config()
     
     if hasattr(args, 'install_all'):
-        install_all(config)
+        install_all(config, args.jobs, args.zcompile, args.resume, args.trace)
+    elif hasattr(args, 'plan_install'):
+        plan_install(config, args.resume)